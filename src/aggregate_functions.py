@@ -0,0 +1,243 @@
+import numpy as np
+import pandas as pd
+
+
+DIMENSIONS = ('category', 'neighborhood', 'year', 'month', 'week')
+
+
+def _factorize(values):
+    """ Returns (codes, labels, first_seen) for a column where labels are sorted,
+        missing values get the code len(labels) and first_seen orders the labels
+        by first appearance in the column
+    """
+    codes, labels = pd.factorize(values, sort=True)
+    codes = np.where(codes < 0, len(labels), codes)
+    positions = np.full(len(labels) + 1, len(codes))
+    np.minimum.at(positions, codes, np.arange(len(codes)))
+    first_seen = [labels[i] for i in np.argsort(positions[:-1], kind='stable')]
+    return codes, np.asarray(labels, dtype=object), first_seen
+
+
+class CountCube():
+    """ Incident counts by category x neighborhood x year x month x week
+        Built in one vectorized pass over the crime dataframe (one np.bincount
+        over the combined codes of the five columns), after which every count
+        the plots need is a slice and sum of the cube rather than a groupby over
+        the raw rows. The category and neighborhood axes have one extra slot at
+        the end for missing values, so totals still include those rows. The year
+        axis only has the years that occur, so a stray old date adds one slot
+        rather than one per year in between.
+        Rows without a year (no date) are not counted.
+    """
+
+    def __init__(self, df, offense_category_id=None, neighborhood_id=None):
+        """ Args:
+                df: pandas crime dataframe with year, month and week columns
+                offense_category_id: name of the column that categorizes the offense
+                (None puts every row in a single category slot)
+                neighborhood_id: name of the column identifying the neighborhood
+                (None puts every row in a single neighborhood slot)
+        """
+        self.offense_category_id = offense_category_id
+        self.neighborhood_id = neighborhood_id
+        df = df[df['year'].notnull()]
+        n = len(df)
+
+        if offense_category_id is None:
+            cat_codes, self.categories, self.category_order = np.zeros(n, dtype=np.int64), np.array([], dtype=object), []
+        else:
+            cat_codes, self.categories, self.category_order = _factorize(df[offense_category_id])
+        if neighborhood_id is None:
+            nbhd_codes, self.neighborhoods = np.zeros(n, dtype=np.int64), np.array([], dtype=object)
+        else:
+            nbhd_codes, self.neighborhoods, _ = _factorize(df[neighborhood_id])
+
+        year_codes, self.years = pd.factorize(df['year'].to_numpy(dtype=np.int64), sort=True)
+        self.months = np.arange(1, 13)
+        self.weeks = np.arange(1, 54)
+
+        shape = (len(self.categories) + 1, len(self.neighborhoods) + 1, len(self.years), 12, 53)
+        flat = np.ravel_multi_index((cat_codes, nbhd_codes, year_codes,
+                                     df['month'].to_numpy(dtype=np.int64) - 1,
+                                     df['week'].to_numpy(dtype=np.int64) - 1), shape)
+        self.cube = np.bincount(flat, minlength=int(np.prod(shape))).astype(np.int32).reshape(shape)
+
+    def _flat_index(self, df):
+        """ Returns the flat cube positions of the rows of df, or None when a row
+            has a category, neighborhood or year the cube has no slot for
+        """
+        df = df[df['year'].notnull()]
+        codes = []
+        for column, labels in [(self.offense_category_id, self.categories), (self.neighborhood_id, self.neighborhoods)]:
+            if column is None:
+                codes.append(np.zeros(len(df), dtype=np.int64))
+                continue
+            values = df[column]
+            position = pd.Index(labels).get_indexer(values.astype(object))
+            if ((position < 0) & values.notnull().to_numpy()).any():
+                return None
+            codes.append(np.where(position < 0, len(labels), position))
+        year = pd.Index(self.years).get_indexer(df['year'].to_numpy(dtype=np.int64))
+        if (year < 0).any():
+            return None
+        return np.ravel_multi_index((codes[0], codes[1], year,
+                                     df['month'].to_numpy(dtype=np.int64) - 1,
+                                     df['week'].to_numpy(dtype=np.int64) - 1), self.cube.shape)
+
+    def apply_delta(self, removed, added):
+        """ Updates the counts in place for rows taken out of (removed) and put
+            into (added) the dataframe the cube was built from
+            Returns False, leaving the cube unchanged, when added has a category,
+            neighborhood or year the cube has no slot for; the cube then has to
+            be rebuilt.
+            Args:
+                removed: pandas dataframe of the rows removed
+                added: pandas dataframe of the rows added
+        """
+        removed_index, added_index = self._flat_index(removed), self._flat_index(added)
+        if removed_index is None or added_index is None:
+            return False
+        size = self.cube.size
+        delta = np.bincount(added_index, minlength=size) - np.bincount(removed_index, minlength=size)
+        self.cube += delta.reshape(self.cube.shape).astype(np.int32)
+        return True
+
+    def _labels(self, dim):
+        return {'category': self.categories, 'neighborhood': self.neighborhoods,
+                'year': self.years, 'month': self.months, 'week': self.weeks}[dim]
+
+    def _positions(self, dim, values):
+        labels = self._labels(dim)
+        lookup = {label: i for i, label in enumerate(labels)}
+        return np.array([lookup[v] for v in values if v in lookup], dtype=np.int64)
+
+    def counts(self, by, categories=None, neighborhoods=None, years=None, exclude_years=(), nonzero=True):
+        """ Returns a dataframe with one column per dimension in by plus 'count',
+            sorted by the by columns like a groupby would be
+            Args:
+                by: list of dimensions to group by, from
+                'category', 'neighborhood', 'year', 'month', 'week'
+                categories: list of categories to count (None counts all)
+                neighborhoods: list of neighborhoods to count (None counts all)
+                years: list of years to count (None counts all)
+                exclude_years: list of years left out of the count
+                nonzero: drop groups with a count of 0, as a groupby would
+        """
+        index = [np.arange(n) for n in self.cube.shape]
+        if categories is not None:
+            index[0] = self._positions('category', categories)
+        if neighborhoods is not None:
+            index[1] = self._positions('neighborhood', neighborhoods)
+        if years is not None:
+            index[2] = self._positions('year', years)
+        index[2] = index[2][~np.isin(self.years[index[2]], list(exclude_years))]
+        for dim in ('category', 'neighborhood'):
+            axis = DIMENSIONS.index(dim)
+            if dim in by:
+                index[axis] = index[axis][index[axis] < len(self._labels(dim))]
+
+        axes = [DIMENSIONS.index(dim) for dim in by]
+        summed = self.cube[np.ix_(*index)].sum(axis=tuple(a for a in range(5) if a not in axes))
+        summed = np.transpose(summed, np.argsort(np.argsort(axes)))
+        grid = np.indices(summed.shape).reshape(len(by), -1)
+        result = pd.DataFrame({dim: self._labels(dim)[index[axis]][grid[i]]
+                               for i, (dim, axis) in enumerate(zip(by, axes))})
+        result['count'] = summed.reshape(-1)
+        if nonzero:
+            result = result[result['count'] > 0].reset_index(drop=True)
+        return result.sort_values(list(by), kind='stable').reset_index(drop=True)
+
+    def category_labels(self, exclude_years=()):
+        """ Returns the categories with at least one incident outside exclude_years
+            in order of first appearance in the data
+        """
+        observed = set(self.counts(['category'], exclude_years=exclude_years)['category'])
+        return [c for c in self.category_order if c in observed]
+
+    def year_range(self, exclude_years=()):
+        """ Returns (first year, last year) with incidents outside exclude_years """
+        years = self.counts(['year'], exclude_years=exclude_years)['year']
+        return int(years.min()), int(years.max())
+
+
+class DailyCountIndex():
+    """ Cumulative daily incident counts by category x neighborhood
+        days holds the distinct days with incidents and cumulative[c, n, d] is
+        the number of incidents of category c in neighborhood n before days[d],
+        so the count for any date range is the difference of two slices, found
+        with np.searchsorted, whatever the range length. Only days that occur
+        get a slot, so a stray old date adds one column rather than one per day
+        in between. As in CountCube, the category and neighborhood axes have an
+        extra slot at the end for missing values. Rows without a date are not
+        counted.
+    """
+
+    def __init__(self, df, date_col, offense_category_id='OFFENSE_CATEGORY_ID', neighborhood_id='NEIGHBORHOOD_ID'):
+        """ Args:
+                df: pandas crime dataframe
+                date_col: datetime column incidents are dated by
+                offense_category_id: name of the column that categorizes the offense
+                neighborhood_id: name of the column identifying the neighborhood
+        """
+        df = df[df[date_col].notnull()]
+        cat_codes, self.categories, _ = _factorize(df[offense_category_id])
+        nbhd_codes, self.neighborhoods, _ = _factorize(df[neighborhood_id])
+        day_codes, self.days = pd.factorize(df[date_col].to_numpy(dtype='datetime64[D]'), sort=True)
+        self.days = np.asarray(self.days, dtype='datetime64[D]')
+        n_days = len(self.days)
+
+        shape = (len(self.categories) + 1, len(self.neighborhoods) + 1, n_days)
+        flat = np.ravel_multi_index((cat_codes, nbhd_codes, day_codes), shape)
+        daily = np.bincount(flat, minlength=int(np.prod(shape))).reshape(shape)
+        self.cumulative = np.zeros(shape[:2] + (n_days + 1,), dtype=np.int32)
+        np.cumsum(daily, axis=2, out=self.cumulative[:, :, 1:])
+        self._category_lookup = {label: i for i, label in enumerate(self.categories)}
+        self._neighborhood_lookup = {label: i for i, label in enumerate(self.neighborhoods)}
+
+    def day_range(self, start=None, end=None):
+        """ Returns the (first, last) positions on the last axis of cumulative
+            covering the days from start to end inclusive (None is open ended)
+        """
+        first = 0 if start is None else int(np.searchsorted(self.days, np.datetime64(start, 'D')))
+        last = len(self.days) if end is None else int(np.searchsorted(self.days, np.datetime64(end, 'D'), side='right'))
+        return first, max(last, first)
+
+    def matrix(self, start=None, end=None):
+        """ Returns the category x neighborhood counts of incidents from start to
+            end (dates, inclusive; None is open ended)
+        """
+        first, last = self.day_range(start, end)
+        return self.cumulative[:, :, last] - self.cumulative[:, :, first]
+
+    def counts(self, by, categories=None, neighborhoods=None, start=None, end=None, nonzero=True):
+        """ Returns a dataframe with one column per dimension in by plus 'count'
+            Args:
+                by: list of dimensions to group by, from 'category', 'neighborhood'
+                categories: list of categories to count (None counts all)
+                neighborhoods: list of neighborhoods to count (None counts all)
+                start: first date counted (None counts from the first incident)
+                end: last date counted (None counts to the last incident)
+                nonzero: drop groups with a count of 0, as a groupby would
+        """
+        matrix = self.matrix(start, end)
+        index = [np.arange(n) for n in matrix.shape]
+        for axis, (values, lookup) in enumerate([(categories, self._category_lookup),
+                                                 (neighborhoods, self._neighborhood_lookup)]):
+            if values is not None:
+                index[axis] = np.array([lookup[v] for v in values if v in lookup], dtype=np.int64)
+        for axis, (dim, labels) in enumerate([('category', self.categories), ('neighborhood', self.neighborhoods)]):
+            if dim in by:
+                index[axis] = index[axis][index[axis] < len(labels)]
+        sub = matrix[np.ix_(*index)]
+        if not by:
+            return pd.DataFrame({'count': [int(sub.sum())]})
+        axes = [('category', 'neighborhood').index(dim) for dim in by]
+        summed = sub.sum(axis=tuple(a for a in range(2) if a not in axes))
+        summed = np.transpose(summed, np.argsort(np.argsort(axes)))
+        grid = np.indices(summed.shape).reshape(len(by), -1)
+        labels = {'category': self.categories, 'neighborhood': self.neighborhoods}
+        result = pd.DataFrame({dim: labels[dim][index[axis]][grid[i]] for i, (dim, axis) in enumerate(zip(by, axes))})
+        result['count'] = summed.reshape(-1)
+        if nonzero:
+            result = result[result['count'] > 0].reset_index(drop=True)
+        return result
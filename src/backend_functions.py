@@ -0,0 +1,231 @@
+import os
+import glob
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+import pyarrow.dataset as ds
+
+
+PARTITION_DIR = '../data/partitions'
+
+PARTITION_COLS = ['city', 'year']
+
+
+def write_partitions(df, root=PARTITION_DIR):
+    """ Writes df as parquet partitioned by city and year
+        (root/city=Denver/year=2020/...), the layout the partitioned backends scan
+        The city/year folders df covers are replaced, so writing again (e.g.
+        after a refresh) does not duplicate rows; other partitions are kept.
+        Args:
+            df: pandas crime dataframe with 'city' and 'year' columns
+            (see schema_functions.load_cities)
+            root: folder the partitions are written under
+    """
+    df = df.copy()
+    df['city'] = df['city'].astype(str)
+    df.to_parquet(root, partition_cols=PARTITION_COLS, index=False, existing_data_behavior='delete_matching')
+
+
+def _partition_values(path, root):
+    """ Returns the {column: value} a partition folder encodes """
+    values = {}
+    for part in os.path.relpath(path, root).split(os.sep):
+        column, value = part.split('=', 1)
+        values[column] = int(value) if column == 'year' else value
+    return values
+
+
+def _sort_counts(counts, by):
+    return counts.sort_values(list(by)).reset_index(drop=True)
+
+
+def _empty_counts(by):
+    return pd.DataFrame(columns=list(by) + ['count'])
+
+
+def _filters_match_nothing(filters):
+    # an empty list of allowed values matches no rows (and IN () is not valid SQL)
+    return any(len(values) == 0 for values in (filters or {}).values())
+
+
+class PandasBackend():
+    """ Runs counts over an in-memory dataframe on a single core """
+
+    def __init__(self, df):
+        self.df = df
+
+    def count(self, by, filters=None):
+        """ Returns a dataframe with the by columns and 'count', the number of
+            incidents in each group, like df.groupby(by).size()
+            Args:
+                by: list of columns to group by
+                filters: dict of column -> list of allowed values
+        """
+        if _filters_match_nothing(filters):
+            return _empty_counts(by)
+        df = self.df
+        for column, values in (filters or {}).items():
+            df = df[df[column].isin(values)]
+        counts = df.groupby(list(by), observed=True).size().rename('count').reset_index()
+        return _sort_counts(counts, by)
+
+
+def _count_partition(path, partition, by, filters):
+    """ Counts one partition folder, reading only the columns by needs and
+        pushing the non partition filters down to the parquet reader
+        When by only has partition columns no column is read at all: the rows
+        are counted from the parquet metadata (or from the filter columns).
+    """
+    columns = [col for col in by if col not in partition]
+    row_filters = {col: list(values) for col, values in filters.items() if col not in partition}
+    if not columns:
+        expression = None
+        for column, values in row_filters.items():
+            condition = ds.field(column).isin(values)
+            expression = condition if expression is None else expression & condition
+        rows = ds.dataset(path, format='parquet').count_rows(filter=expression)
+        if not rows:
+            return _empty_counts(by)
+        return pd.DataFrame({**{col: [partition[col]] for col in by}, 'count': [rows]})
+    df = pd.read_parquet(path, columns=columns,
+                         filters=[(col, 'in', values) for col, values in row_filters.items()] or None)
+    for column, value in partition.items():
+        df[column] = value
+    return df.groupby(list(by), observed=True).size().rename('count').reset_index()
+
+
+class PartitionPoolBackend():
+    """ Runs counts over city/year parquet partitions (see write_partitions)
+        across a process pool: partitions are pruned by the city/year filters
+        before anything is read, each worker counts one partition, and the
+        partial counts are summed
+    """
+
+    def __init__(self, root=PARTITION_DIR, processes=None):
+        self.root = root
+        self.processes = processes
+
+    def _partitions(self, filters):
+        paths = sorted(glob.glob(os.path.join(self.root, *['*'] * len(PARTITION_COLS))))
+        partitions = []
+        for path in paths:
+            partition = _partition_values(path, self.root)
+            if all(partition[col] in values for col, values in filters.items() if col in partition):
+                partitions.append((path, partition))
+        return partitions
+
+    def count(self, by, filters=None):
+        """ Returns a dataframe with the by columns and 'count', the number of
+            incidents in each group, like df.groupby(by).size()
+            Args:
+                by: list of columns to group by
+                filters: dict of column -> list of allowed values
+        """
+        filters = filters or {}
+        if _filters_match_nothing(filters):
+            return _empty_counts(by)
+        partitions = self._partitions(filters)
+        if not partitions:
+            return _empty_counts(by)
+        args = [(path, partition, by, filters) for path, partition in partitions]
+        if self.processes == 1:
+            parts = [_count_partition(*arg) for arg in args]
+        else:
+            with ProcessPoolExecutor(self.processes) as pool:
+                parts = list(pool.map(_count_partition, *zip(*args)))
+        counts = pd.concat(parts, ignore_index=True).groupby(list(by), observed=True)['count'].sum().reset_index()
+        return _sort_counts(counts, by)
+
+
+class DuckDBBackend():
+    """ Runs counts as SQL over the city/year parquet partitions with DuckDB,
+        which prunes partitions, pushes filters into the scan and uses every
+        core (requires the optional duckdb package)
+    """
+
+    def __init__(self, root=PARTITION_DIR):
+        import duckdb
+        self.connection = duckdb.connect()
+        self.source = f"read_parquet('{os.path.join(root, '**', '*.parquet')}', hive_partitioning = true)"
+
+    def count(self, by, filters=None):
+        """ Returns a dataframe with the by columns and 'count', the number of
+            incidents in each group, like df.groupby(by).size()
+            Args:
+                by: list of columns to group by
+                filters: dict of column -> list of allowed values
+        """
+        if _filters_match_nothing(filters):
+            return _empty_counts(by)
+        columns = ', '.join(f'"{col}"' for col in by)
+        # groupby drops missing keys, so do the same
+        where = [f'"{col}" IS NOT NULL' for col in by]
+        params = []
+        for column, values in (filters or {}).items():
+            where.append(f'"{column}" IN ({", ".join("?" for _ in values)})')
+            params.extend(values)
+        query = (f'SELECT {columns}, count(*) AS count FROM {self.source} '
+                 f'WHERE {" AND ".join(where)} GROUP BY {columns}')
+        counts = self.connection.execute(query, params).df()
+        return _sort_counts(counts, by)
+
+
+def get_backend(name, df=None, root=PARTITION_DIR, processes=None):
+    """ Returns a count backend by name
+        Args:
+            name: 'pandas' (in memory, needs df), 'pool' (process pool over
+            partitions) or 'duckdb' (DuckDB over partitions)
+            df: pandas crime dataframe for the pandas backend
+            root: folder of the city/year partitions
+            processes: number of worker processes for the pool backend
+    """
+    if name == 'pandas':
+        return PandasBackend(df)
+    if name == 'pool':
+        return PartitionPoolBackend(root, processes)
+    if name == 'duckdb':
+        return DuckDBBackend(root)
+    raise ValueError(f"backend must be 'pandas', 'pool' or 'duckdb', not {name!r}")
+
+
+def _city_filter(backend, city):
+    """ Returns the filter restricting counts to city; a single city frame
+        (a pandas backend without a 'city' column) is counted whole
+    """
+    if city is None or (isinstance(backend, PandasBackend) and 'city' not in backend.df.columns):
+        return {}
+    return {'city': [city]}
+
+
+def category_counts_by_year(backend, offense_category_id='OFFENSE_CATEGORY_ID', exclude_years=(2021,), city=None):
+    """ Returns counts by year and category in the shape
+        CrimeDataFrame.barplot_city_crime_by_category plots
+        (columns 'year', offense_category_id, 'INCIDENT_ID')
+        Args:
+            backend: a count backend (see get_backend)
+            offense_category_id: name of the column that categorizes the offense
+            exclude_years: years left out
+            city: restrict to one city (None counts every city)
+    """
+    filters = _city_filter(backend, city)
+    counts = backend.count(['year', offense_category_id], filters)
+    counts = counts[~counts['year'].isin(exclude_years)]
+    return counts.rename(columns={'count': 'INCIDENT_ID'}).reset_index(drop=True)
+
+
+def neighborhood_counts(backend, category, years, neighborhood_id='NEIGHBORHOOD_ID',
+                        offense_category_id='OFFENSE_CATEGORY_ID', city='Denver'):
+    """ Returns per neighborhood counts of category in years with the
+        'Neighborhood' and 'Count' columns choropleth_functions.merge_counts_with_shapes
+        takes (neighborhood names as in the raw data, so clean them before
+        merging with the Denver shapes)
+        Args:
+            backend: a count backend (see get_backend)
+            category: the crime category counted
+            years: list of years counted
+            neighborhood_id: name of the column identifying the neighborhood
+            offense_category_id: name of the column that categorizes the offense
+            city: the city counted (None counts every city)
+    """
+    filters = {**_city_filter(backend, city), 'year': list(years), offense_category_id: [category]}
+    counts = backend.count([neighborhood_id], filters)
+    return counts.rename(columns={neighborhood_id: 'Neighborhood', 'count': 'Count'})
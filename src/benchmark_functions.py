@@ -0,0 +1,366 @@
+import os
+import sys
+import time
+import argparse
+import platform
+import subprocess
+from contextlib import contextmanager
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from shapely.geometry import box
+import matplotlib
+import choropleth_functions
+import folium_functions
+import crime
+import profile_functions
+
+
+BENCHMARK_DIR = '../data/benchmark'
+RESULTS_FILE = '../benchmarks/results.csv'
+
+SIZES = [10000, 100000, 1000000, 10000000]
+
+DATE_FORMAT = '%m/%d/%Y %I:%M:%S %p'
+
+DATE_COLS = ['FIRST_OCCURRENCE_DATE', 'LAST_OCCURRENCE_DATE', 'REPORTED_DATE']
+
+# Denver area the synthetic neighborhoods tile
+BOUNDS = (-105.11, 39.61, -104.60, 39.91)
+
+# Shapefile names, with the crime csv NEIGHBORHOOD_ID derived from them as the
+# Denver export does ('Cory - Merrill' -> 'cory-merrill'). 'CBD' is dropped from
+# the shapes by prepare_shapefile_dataframe, as in the real data.
+NEIGHBORHOODS = ['Athmar Park', 'Auraria', 'Baker', 'Barnum', 'Bear Valley', 'Berkeley', 'Capitol Hill', 'CBD',
+                 'Central Park', 'Cheesman Park', 'Civic Center', 'Clayton', 'Cole', 'Congress Park',
+                 'Cory - Merrill', 'Country Club', 'DIA', 'Five Points', 'Globeville', 'Hale', 'Hampden',
+                 'Highland', 'Jefferson Park', 'Lincoln Park', 'Montbello', 'North Capitol Hill', 'Platt Park',
+                 'Ruby Hill', 'Speer', 'Sunnyside', 'Union Station', 'University', 'Virginia Village',
+                 'Washington Park', 'West Colfax', 'Westwood']
+
+# Denver offense categories with roughly their share of incidents
+CATEGORIES = {'all-other-crimes': 0.22, 'larceny': 0.14, 'traffic-accident': 0.13, 'public-disorder': 0.1,
+              'theft-from-motor-vehicle': 0.09, 'auto-theft': 0.07, 'drug-alcohol': 0.06, 'burglary': 0.05,
+              'other-crimes-against-persons': 0.04, 'white-collar-crime': 0.03, 'aggravated-assault': 0.03,
+              'robbery': 0.015, 'sexual-assault': 0.01, 'arson': 0.003, 'murder': 0.002}
+
+
+def _neighborhood_slug(name):
+    return choropleth_functions.clean_shape_names(name).lower().replace(' ', '-')
+
+
+def _neighborhood_polygons(n):
+    """ Returns n boxes tiling BOUNDS in a near square grid """
+    columns = int(np.ceil(np.sqrt(n)))
+    rows = int(np.ceil(n / columns))
+    width = (BOUNDS[2] - BOUNDS[0]) / columns
+    height = (BOUNDS[3] - BOUNDS[1]) / rows
+    return [box(BOUNDS[0] + (i % columns) * width, BOUNDS[1] + (i // columns) * height,
+                BOUNDS[0] + (i % columns + 1) * width, BOUNDS[1] + (i // columns + 1) * height) for i in range(n)]
+
+
+def write_synthetic_shapefile(folder):
+    """ Writes statistical_neighborhoods.shp (NBHD_ID, NBHD_NAME, TYPOLOGY, NOTES
+        and a polygon per NEIGHBORHOODS name) into folder
+        Returns the shape geodataframe
+    """
+    shape_df = gpd.GeoDataFrame({'NBHD_ID': range(1, len(NEIGHBORHOODS) + 1), 'NBHD_NAME': NEIGHBORHOODS,
+                                 'TYPOLOGY': '', 'NOTES': ''},
+                                geometry=_neighborhood_polygons(len(NEIGHBORHOODS)), crs='EPSG:4326')
+    os.makedirs(folder, exist_ok=True)
+    shape_df.to_file(os.path.join(folder, 'statistical_neighborhoods.shp'))
+    return shape_df
+
+
+def _format_dates(seconds, start):
+    """ Formats seconds since start as DATE_FORMAT strings, formatting each
+        distinct day and time of day once
+    """
+    days, time_of_day = np.divmod(seconds, 86400)
+    day_labels, day_index = np.unique(days, return_inverse=True)
+    day_strings = (start + pd.to_timedelta(day_labels, unit='D')).strftime('%m/%d/%Y ').to_numpy(dtype=object)
+    time_labels, time_index = np.unique(time_of_day, return_inverse=True)
+    time_strings = (start + pd.to_timedelta(time_labels, unit='s')).strftime('%I:%M:%S %p').to_numpy(dtype=object)
+    return day_strings[day_index.reshape(-1)] + time_strings[time_index.reshape(-1)]
+
+
+def synthetic_crime_chunk(n, rng, first_id, polygons):
+    """ Returns n synthetic incidents with the Denver crime csv columns
+        Incidents fall from 2016 to March 2021; each lies inside the polygon of
+        its neighborhood, with about 1% missing neighborhood and 1% missing
+        coordinates
+        Args:
+            n: number of incidents
+            rng: numpy random generator
+            first_id: INCIDENT_ID of the first incident
+            polygons: list of (min lon, min lat, max lon, max lat), one per NEIGHBORHOODS name
+    """
+    start = pd.Timestamp('2016-01-01')
+    span = int((pd.Timestamp('2021-04-01') - start).total_seconds())
+    first = rng.integers(0, span, n)
+    reported = first + rng.integers(0, 3 * 86400, n)
+
+    categories = np.array(list(CATEGORIES), dtype=object)
+    weights = np.array(list(CATEGORIES.values()))
+    category = categories[rng.choice(len(categories), n, p=weights / weights.sum())]
+
+    hood = rng.integers(0, len(NEIGHBORHOODS), n)
+    bounds = np.array(polygons)[hood]
+    lon = bounds[:, 0] + (bounds[:, 2] - bounds[:, 0]) * rng.uniform(0.01, 0.99, n)
+    lat = bounds[:, 1] + (bounds[:, 3] - bounds[:, 1]) * rng.uniform(0.01, 0.99, n)
+    neighborhood = np.array([_neighborhood_slug(name) for name in NEIGHBORHOODS], dtype=object)[hood]
+    neighborhood[rng.random(n) < 0.01] = None
+    no_location = rng.random(n) < 0.01
+    lon[no_location] = np.nan
+    lat[no_location] = np.nan
+
+    ids = np.arange(first_id, first_id + n)
+    return pd.DataFrame({'INCIDENT_ID': ids,
+                         'OFFENSE_ID': ids * 100 + 1,
+                         'OFFENSE_CODE': rng.integers(2000, 7400, n),
+                         'OFFENSE_CODE_EXTENSION': rng.integers(0, 3, n),
+                         'OFFENSE_TYPE_ID': category + np.where(rng.random(n) < 0.5, '-other', ''),
+                         'OFFENSE_CATEGORY_ID': category,
+                         'FIRST_OCCURRENCE_DATE': _format_dates(first, start),
+                         'LAST_OCCURRENCE_DATE': _format_dates(first + rng.integers(0, 86400, n), start),
+                         'REPORTED_DATE': _format_dates(reported, start),
+                         'INCIDENT_ADDRESS': '',
+                         'GEO_X': np.round(lon * 10000),
+                         'GEO_Y': np.round(lat * 10000),
+                         'GEO_LON': lon,
+                         'GEO_LAT': lat,
+                         'DISTRICT_ID': rng.integers(1, 8, n),
+                         'PRECINCT_ID': rng.integers(100, 800, n),
+                         'NEIGHBORHOOD_ID': neighborhood,
+                         'IS_CRIME': (category != 'traffic-accident').astype(int),
+                         'IS_TRAFFIC': (category == 'traffic-accident').astype(int)})
+
+
+def generate_synthetic_dataset(rows, root=None, seed=0, chunksize=1000000):
+    """ Writes a synthetic Denver dataset laid out like the repo
+        (root/data/denver_crime.csv, root/data/statistical_neighborhoods/) with
+        root/html and root/images/Denver for the outputs, and returns root
+        The data only depends on rows and seed, so an existing dataset is reused.
+        Args:
+            rows: number of incidents
+            root: folder to write to (default BENCHMARK_DIR/denver_<rows>_<seed>)
+            seed: random seed
+            chunksize: number of incidents generated and written at a time
+    """
+    root = root or os.path.join(BENCHMARK_DIR, f'denver_{rows}_{seed}')
+    csv = os.path.join(root, 'data', 'denver_crime.csv')
+    for folder in ['src', 'html', os.path.join('images', 'Denver')]:
+        os.makedirs(os.path.join(root, folder), exist_ok=True)
+    if os.path.exists(csv):
+        return root
+    shape_df = write_synthetic_shapefile(os.path.join(root, 'data', 'statistical_neighborhoods'))
+    polygons = [geometry.bounds for geometry in shape_df.geometry]
+    rng = np.random.default_rng(seed)
+    partial = csv + '.partial'
+    for first in range(0, rows, chunksize):
+        chunk = synthetic_crime_chunk(min(chunksize, rows - first), rng, 2016000000 + first, polygons)
+        chunk.to_csv(partial, mode='a' if first else 'w', header=not first, index=False)
+    os.replace(partial, csv)
+    return root
+
+
+@contextmanager
+def _working_directory(path):
+    previous = os.getcwd()
+    os.chdir(path)
+    try:
+        yield
+    finally:
+        os.chdir(previous)
+
+
+def _pipeline_stages(category, year1, year2, slow_map_rows):
+    """ Returns [(stage, function(state), max_rows)]; each function reads what
+        it needs from the state dict and stores its output there
+    """
+    def load(state):
+        state['crime'] = crime.CrimeDataFrame('../data/denver_crime.csv', DATE_COLS, DATE_FORMAT, 'FIRST_OCCURRENCE_DATE')
+
+    def load_chunked(state):
+        crime.CrimeDataFrame.from_csv_chunks('../data/denver_crime.csv', ['FIRST_OCCURRENCE_DATE'], DATE_FORMAT,
+                                             'FIRST_OCCURRENCE_DATE')
+
+    def shapefile(state):
+        state['shape_df'] = choropleth_functions.prepare_shapefile_dataframe()
+
+    def geodataframe(state):
+        state['geo_df'] = choropleth_functions.create_denver_geodataframe(state['crime'].df, state['shape_df'])
+
+    def spatial_join(state):
+        choropleth_functions.create_denver_geodataframe(state['crime'].df, state['shape_df'], join='spatial')
+
+    def count(state):
+        choropleth_functions.count_by_category_and_year(state['geo_df'], state['shape_df'], category, [year1])
+
+    def compare_two_years(state):
+        choropleth_functions.choropleth_compare_two_years(state['crime'].df, category, year1, year2)
+
+    def count_cube(state):
+        state['crime'].count_cube('OFFENSE_CATEGORY_ID', 'NEIGHBORHOOD_ID')
+
+    def barplot(state):
+        state['crime'].barplot_city_crime_by_category('OFFENSE_CATEGORY_ID', 'INCIDENT_ID', 'Denver')
+        matplotlib.pyplot.close('all')
+
+    def cluster_map(fast, cell_size=None):
+        def stage(state):
+            categories = sorted(state['crime'].df['OFFENSE_CATEGORY_ID'].unique())
+            folium_functions.make_layered_clustered_map(state['crime'].df, [39.7177, -104.9208], categories,
+                                                        'OFFENSE_CATEGORY_ID', 'GEO_LAT', 'GEO_LON', 'Denver',
+                                                        fast=fast, cell_size=cell_size, year=year1)
+        return stage
+
+    return [('load_csv', load, None),
+            ('load_csv_chunked', load_chunked, None),
+            ('prepare_shapefile', shapefile, None),
+            ('create_geodataframe', geodataframe, None),
+            ('create_geodataframe_spatial', spatial_join, None),
+            ('count_by_category_and_year', count, None),
+            ('choropleth_compare_two_years', compare_two_years, None),
+            ('count_cube', count_cube, None),
+            ('barplot_city_crime_by_category', barplot, None),
+            ('clustered_map', cluster_map(False), slow_map_rows),
+            ('clustered_map_fast', cluster_map(True), None),
+            ('clustered_map_grid', cluster_map(True, 0.001), None)]
+
+
+def run_benchmark(rows, seed=0, memory=True, category='auto-theft', year1=2020, year2=2019, slow_map_rows=100000):
+    """ Generates (or reuses) a synthetic dataset of rows incidents and times each
+        pipeline stage on it in order, returning a dataframe with a row per stage
+        (stage, seconds, peak_mb, rss_mb, output_mb)
+        Stages run in the dataset folder, so outputs land in its html and images
+        folders and nothing in the repo is overwritten.
+        Args:
+            rows: number of synthetic incidents
+            seed: random seed of the dataset
+            memory: whether to trace allocations for peak_mb (slows object heavy stages)
+            category: category the choropleth and count stages use
+            year1, year2: years the choropleth and map stages use
+            slow_map_rows: the per marker folium map is skipped above this many rows
+    """
+    matplotlib.use('Agg')
+    root = generate_synthetic_dataset(rows, seed=seed)
+    profiling = profile_functions.enabled()
+    if not profiling:
+        profile_functions.enable(memory=memory, report=False)
+    results = []
+    state = {}
+    with _working_directory(os.path.join(root, 'src')):
+        for stage, function, max_rows in _pipeline_stages(category, year1, year2, slow_map_rows):
+            if max_rows is not None and rows > max_rows:
+                continue
+            started = time.time()
+            with profile_functions.stage(f'benchmark {stage}', rows=rows):
+                function(state)
+            record = profile_functions.records().iloc[-1]
+            results.append({'stage': stage, 'seconds': record['seconds'], 'peak_mb': record['peak_mb'],
+                            'rss_mb': record['rss_mb'],
+                            'output_mb': _output_bytes('..', ['html', 'images'], started) / 2 ** 20})
+            print(f"{rows:>10,} {stage:<32} {record['seconds']:8.2f}s"
+                  + (f" {record['peak_mb']:8.0f} MB" if pd.notnull(record['peak_mb']) else ''))
+    if not profiling:
+        profile_functions.disable()
+    return pd.DataFrame(results, columns=['stage', 'seconds', 'peak_mb', 'rss_mb', 'output_mb'])
+
+
+def _output_bytes(root, folders, since):
+    """ Returns the total size of the files in root/folders written at or after
+        since (a time.time() timestamp)
+    """
+    total = 0
+    for folder in folders:
+        for path, _, files in os.walk(os.path.join(root, folder)):
+            for name in files:
+                stat = os.stat(os.path.join(path, name))
+                if stat.st_mtime >= since:
+                    total += stat.st_size
+    return total
+
+
+def current_commit():
+    """ Returns the short hash of HEAD ('-dirty' appended when the tree has
+        uncommitted changes), or 'unknown' outside a git checkout
+    """
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], capture_output=True,
+                               text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+    return commit + ('-dirty' if dirty else '')
+
+
+def run_benchmarks(sizes=SIZES, seed=0, memory=True, results_file=RESULTS_FILE, **kwargs):
+    """ Runs run_benchmark for each size and appends the stage results, tagged
+        with the commit, date, python version and machine, to results_file
+        Returns the new results
+        Args:
+            sizes: list of row counts
+            seed: random seed of the datasets
+            memory: whether to trace allocations for peak_mb
+            results_file: csv the results are appended to
+            kwargs: passed to run_benchmark
+    """
+    commit = current_commit()
+    runs = []
+    for rows in sizes:
+        result = run_benchmark(rows, seed=seed, memory=memory, **kwargs)
+        result.insert(0, 'rows', rows)
+        runs.append(result)
+    results = pd.concat(runs, ignore_index=True)
+    results.insert(0, 'commit', commit)
+    results.insert(1, 'date', pd.Timestamp.now().strftime('%Y-%m-%d %H:%M:%S'))
+    results['python'] = platform.python_version()
+    results['machine'] = f'{platform.machine()} {os.cpu_count()} cpu'
+    if results_file is not None:
+        os.makedirs(os.path.dirname(results_file), exist_ok=True)
+        results.to_csv(results_file, mode='a', header=not os.path.exists(results_file), index=False)
+    return results
+
+
+def compare_benchmarks(base, head, results_file=RESULTS_FILE, threshold=0.1):
+    """ Returns a dataframe comparing two commits' results stage by stage and
+        size by size (the latest run of each), with the head/base ratio of
+        seconds and peak_mb and a 'regression' flag where either grew by more
+        than threshold
+        Args:
+            base: commit to compare against (as recorded in results_file)
+            head: commit being compared
+            results_file: csv written by run_benchmarks
+            threshold: relative increase counted as a regression (0.1 is 10%)
+    """
+    results = pd.read_csv(results_file)
+    latest = (results[results['commit'].isin([base, head])]
+              .sort_values('date', kind='stable')
+              .groupby(['commit', 'rows', 'stage'], sort=False)[['seconds', 'peak_mb']]
+              .last())
+    comparison = latest.loc[base].join(latest.loc[head], lsuffix='_base', rsuffix='_head', how='inner')
+    comparison['seconds_ratio'] = comparison['seconds_head'] / comparison['seconds_base']
+    comparison['peak_mb_ratio'] = comparison['peak_mb_head'] / comparison['peak_mb_base']
+    comparison['regression'] = ((comparison['seconds_ratio'] > 1 + threshold)
+                                | (comparison['peak_mb_ratio'] > 1 + threshold))
+    return comparison.reset_index().sort_values('rows', kind='stable').reset_index(drop=True)
+
+
+if __name__ == '__main__':
+    """ Runs the benchmark suite from the src folder, e.g.
+        python benchmark_functions.py --sizes 10000 100000
+        python benchmark_functions.py --compare <base commit> <head commit>
+    """
+    parser = argparse.ArgumentParser(description='Benchmark the crime pipeline on synthetic Denver data')
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES[:2], help='numbers of synthetic incidents')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-memory', action='store_true', help='skip allocation tracing')
+    parser.add_argument('--compare', nargs=2, metavar=('BASE', 'HEAD'), help='compare two recorded commits')
+    args = parser.parse_args()
+    if args.compare:
+        comparison = compare_benchmarks(*args.compare)
+        print(comparison.to_string(index=False, float_format='{:.2f}'.format))
+        sys.exit(int(comparison['regression'].any()))
+    run_benchmarks(args.sizes, seed=args.seed, memory=not args.no_memory)
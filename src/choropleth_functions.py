@@ -1,20 +1,25 @@
+import os
+import json
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import numpy as np
 import pandas as pd
 import geopandas as gpd
+import shapely
 import folium
+from branca.colormap import StepColormap
+from branca.utilities import color_brewer
+import backend_functions
+import profile_functions
+from profile_functions import profiled
+from normalize_functions import clean_shape_names, clean_neighborhood_names
+import normalize_functions
 
 
-def clean_shape_names(string):
-    return string.replace('- ', '')
-
-
-def clean_neighborhood_names(string):
-    name = ' '.join([x.capitalize() for x in string.split('-')])
-    if name == 'Dia':
-        return 'DIA'
-    return name
+NEIGHBORHOOD_ASSET = '../html/denver_neighborhoods.geojson'
 
 
+@profiled()
 def prepare_shapefile_dataframe():
     """ Returns a cleaned pandas dataframe from .shp file provided on
         https://www.denvergov.org/opendata/dataset/city-and-county-of-denver-statistical-neighborhoods
@@ -31,43 +36,136 @@ def prepare_shapefile_dataframe():
     return shape_df
 
 
-def create_denver_geodataframe(crime_df, shape_df):
+def locate_neighborhoods(crime_df, shape_df, geo_lat='GEO_LAT', geo_lon='GEO_LON'):
+    """ Returns a series (aligned with crime_df) of the NBHD_NAME of the shape_df
+        polygon each incident falls in, or NaN when the coordinates are missing
+        or outside every polygon
+        Points are joined in bulk against an STRtree of the polygons, so this
+        does not depend on the NEIGHBORHOOD_ID labels at all.
+        Args:
+            crime_df: pandas crime data frame
+            shape_df: pandas shape data frame (see prepare_shapefile_dataframe)
+            geo_lat: the name of the column with the latitude coordinate
+            geo_lon: the name of the column with the longitude coordinate
+    """
+    if shape_df.crs is not None and not shape_df.crs.equals('EPSG:4326'):
+        shape_df = shape_df.to_crs('EPSG:4326')
+    lat = crime_df[geo_lat].to_numpy(dtype=float)
+    lon = crime_df[geo_lon].to_numpy(dtype=float)
+    valid = np.flatnonzero(~(np.isnan(lat) | np.isnan(lon)))
+    points = shapely.points(lon[valid], lat[valid])
+    tree = shapely.STRtree(shape_df.geometry.values)
+    point_idx, polygon_idx = tree.query(points, predicate='intersects')
+    # a point on a shared border matches both polygons; keep the first
+    point_idx, first = np.unique(point_idx, return_index=True)
+    names = np.full(len(crime_df), np.nan, dtype=object)
+    names[valid[point_idx]] = shape_df['NBHD_NAME'].to_numpy()[polygon_idx[first]]
+    return pd.Series(names, index=crime_df.index, name='NEIGHBORHOOD_ID')
+
+
+@profiled()
+def create_denver_geodataframe(crime_df, shape_df, join='name', geometry=False):
     """ Args:
             crime_df: pandas crime data frame
             shape_df: pandas shape data frame for
             same location as crime_df
+            join: 'name' matches the cleaned NEIGHBORHOOD_ID (with the
+            normalize_functions.NEIGHBORHOOD_RENAMES applied) to NBHD_NAME,
+            'spatial' places each incident in the polygon containing its
+            GEO_LAT/GEO_LON (recovers incidents without a NEIGHBORHOOD_ID and
+            follows renames like Stapleton to Central Park automatically)
+            geometry: if True, merge the shape_df columns (including the polygons)
+            onto every incident as before
 
-        Returns a pandas dataframe merging crime_df and shape_df by neighborhoods
+        Returns a slim incident table (INCIDENT_ID, OFFENSE_CATEGORY_ID, year,
+        NEIGHBORHOOD_ID) with the category and neighborhood stored as categoricals,
+        the neighborhood categories being the shape_df NBHD_NAMEs. Geometry is only
+        joined onto the per-neighborhood counts (see count_by_category_and_year)
+        so it is not copied onto every incident.
         (Removes rows where NEIGHBORHOOD_ID is null or cannot be determined.)
     """
     crime = crime_df[['INCIDENT_ID', 'OFFENSE_CATEGORY_ID', 'year', 'NEIGHBORHOOD_ID']].copy()
-    crime['NEIGHBORHOOD_ID'] = crime['NEIGHBORHOOD_ID'].map(clean_neighborhood_names, na_action='ignore')
-    crime = crime[~((crime['NEIGHBORHOOD_ID'].isin(['cbd', 'Cbd'])) | (crime['NEIGHBORHOOD_ID'].isnull()))]
+    if join == 'spatial':
+        with profile_functions.stage('spatial_join', rows=len(crime)):
+            crime['NEIGHBORHOOD_ID'] = locate_neighborhoods(crime_df, shape_df)
+            crime = crime[crime['NEIGHBORHOOD_ID'].notnull()]
+    elif join == 'name':
+        with profile_functions.stage('clean_neighborhood_names', rows=len(crime)):
+            crime['NEIGHBORHOOD_ID'] = normalize_functions.neighborhood_display_names(crime['NEIGHBORHOOD_ID'])
+            crime = crime[~((crime['NEIGHBORHOOD_ID'].isin(['cbd', 'Cbd'])) | (crime['NEIGHBORHOOD_ID'].isnull()))]
+    else:
+        raise ValueError(f"join must be 'name' or 'spatial', not {join!r}")
 
-    geo_df = pd.merge(left=crime, right=shape_df, left_on='NEIGHBORHOOD_ID', right_on='NBHD_NAME')
-    return geo_df
+    if geometry:
+        with profile_functions.stage('geo_merge', rows=len(crime)):
+            geo_df = pd.merge(left=crime, right=shape_df, left_on='NEIGHBORHOOD_ID', right_on='NBHD_NAME')
+        return geo_df
 
+    crime['NEIGHBORHOOD_ID'] = pd.Categorical(crime['NEIGHBORHOOD_ID'], categories=shape_df['NBHD_NAME'].unique())
+    crime['OFFENSE_CATEGORY_ID'] = crime['OFFENSE_CATEGORY_ID'].astype('category')
+    crime['year'] = pd.to_numeric(crime['year'], downcast='integer')
+    return crime[crime['NEIGHBORHOOD_ID'].notnull()].reset_index(drop=True)
 
-def count_by_category_and_year(df, shape_df, category, years=[2020]):
+
+def benchmark_neighborhood_joins(crime_df, shape_df, repeat=3):
+    """ Times create_denver_geodataframe with the name merge and the spatial join
+        Returns a dataframe with the best time in seconds and the number of
+        incidents kept by each join mode
+        Args:
+            crime_df: pandas crime data frame
+            shape_df: pandas shape data frame (see prepare_shapefile_dataframe)
+            repeat: number of timed runs per join mode
+    """
+    results = []
+    for join in ['name', 'spatial']:
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            geo_df = create_denver_geodataframe(crime_df, shape_df, join=join)
+            times.append(time.perf_counter() - start)
+        results.append({'join': join, 'seconds': min(times), 'rows': len(geo_df),
+                        'rows_dropped': len(crime_df) - len(geo_df)})
+    return pd.DataFrame(results)
+
+
+@profiled()
+def count_by_category_and_year(df, shape_df, category, years=[2020], backend=None):
     """ Finds the counts for the specified category for each neighborhood (NEIGHBORHOOD_ID) for specified years
         Returns dataframe with columns 'id', 'geometry', 'neighborhood', 'Count'
         Args:
-            df: pandas crime dataframe
+            df: pandas crime dataframe (see create_denver_geodataframe)
             shape_df: pandas dataframe of cleaned .shp (see prepare_shapefile_dataframe function above)
             category: a string - the category your finding the counts for
             years: list of years included in count
+            backend: a backend_functions count backend over the raw Denver
+            incidents (e.g. get_backend('duckdb') over the partitions) to count
+            with instead of df; its neighborhood ids are cleaned to the shapefile
+            names (None counts df in memory)
     """
-    count_df = (df[(df['OFFENSE_CATEGORY_ID'] == category) & (df['year'].isin(years))]
-                .groupby('NEIGHBORHOOD_ID')['INCIDENT_ID']
-                .count()
-                .reset_index()
-                .rename(columns={'INCIDENT_ID': 'Count', 'NEIGHBORHOOD_ID': 'Neighborhood'}))
+    if backend is None:
+        count_df = backend_functions.neighborhood_counts(backend_functions.get_backend('pandas', df), category, years)
+    else:
+        count_df = backend_functions.neighborhood_counts(backend, category, years)
+        count_df['Neighborhood'] = normalize_functions.neighborhood_display_names(count_df['Neighborhood'])
+        count_df = count_df.groupby('Neighborhood', observed=True)['Count'].sum().reset_index()
+    return merge_counts_with_shapes(shape_df, count_df)
 
+
+def merge_counts_with_shapes(shape_df, count_df):
+    """ Returns shape_df merged with per neighborhood counts
+        (columns 'id', 'geometry', 'Neighborhood', 'Count')
+        Args:
+            shape_df: pandas dataframe of cleaned .shp (see prepare_shapefile_dataframe function above)
+            count_df: dataframe with columns 'Neighborhood' and 'Count'
+    """
+    count_df = count_df.copy()
+    count_df['Neighborhood'] = count_df['Neighborhood'].astype(object)
     merged_count = pd.merge(left=shape_df, right=count_df, left_on='NBHD_NAME', right_on='Neighborhood').rename(columns={'NBHD_ID': 'id'})
     merged_count.drop(['NBHD_NAME'], axis=1, inplace=True)
     return merged_count
 
 
+@profiled()
 def choropleth_plot(data, myscale, category, years):
     """ Returns a folium choropleth map
         Args:
@@ -110,7 +208,49 @@ def choropleth_plot(data, myscale, category, years):
     return mapa
 
 
-def choropleth_compare_two_years(denver_crime_df, category, year1, year2):
+@profiled()
+def choropleth_plot_from_asset(asset_path, count_field, myscale, category, years):
+    """ Returns a folium choropleth map drawn from a shared GeoJSON asset
+        (see write_neighborhood_asset) instead of embedded geometry
+        Fill colour and tooltip come from a single GeoJson layer; the html
+        references asset_path, so the map and asset should be saved in the same
+        folder and viewed through a web server (browsers block loading local
+        files from a map opened straight from disk).
+        Args:
+            asset_path: path of the GeoJSON asset, as seen both from the working
+            directory and from the saved html file (e.g. '../html/denver_neighborhoods.geojson')
+            count_field: the asset property holding this map's counts
+            myscale: the scale you are specifying for the threshold colour scale
+            category: a string, the crime category you are filtering for
+            years: a list of years to be included in the plot
+    """
+    mapa = folium.Map(location=[39.7807, -104.8208],
+                      tiles="CartoDB positron",
+                      zoom_start=11.25)
+
+    colormap = StepColormap(color_brewer('OrRd', n=len(myscale) - 1), index=myscale,
+                            vmin=myscale[0], vmax=myscale[-1], caption=f'{category} in {years}')
+
+    def style_function(x):
+        return {'fillColor': colormap.rgb_hex_str(x['properties'][count_field]), 'color': '#000000',
+                'fillOpacity': 0.5, 'opacity': 0.75, 'weight': 1}
+
+    folium.GeoJson(
+        asset_path,
+        embed=False,
+        name='choropleth',
+        style_function=style_function,
+        tooltip=folium.features.GeoJsonTooltip(
+            fields=['Neighborhood', count_field],
+            aliases=['Neighborhood: ', f'Count of {category} incidences: '],
+        )
+    ).add_to(mapa)
+    colormap.add_to(mapa)
+    return mapa
+
+
+@profiled()
+def choropleth_compare_two_years(denver_crime_df, category, year1, year2, join='name'):
     """ Saves two choropleth maps as html files for the category and years specified
         Creates a consistent threshold_scale across both years for comparison
         Args:
@@ -118,17 +258,212 @@ def choropleth_compare_two_years(denver_crime_df, category, year1, year2):
             category: a string, the crime category you are filtering for
             year1: a integer specifying the first year you'd like to make a map for in format YYYY
             year2: a integer specifying the second year you'd like to make a map for in format YYYY
+            join: 'name' or 'spatial', how incidents are matched to neighborhoods
+            (see create_denver_geodataframe)
     """
     shape_df = prepare_shapefile_dataframe()
-    geo_df = create_denver_geodataframe(denver_crime_df, shape_df)
+    geo_df = create_denver_geodataframe(denver_crime_df, shape_df, join=join)
 
     year1_data = count_by_category_and_year(geo_df, shape_df, category, [year1])
     year2_data = count_by_category_and_year(geo_df, shape_df, category, [year2])
 
-    myscale = (pd.concat([year1_data, year2_data]).Count.quantile((0, 0.3, 0.8, 0.965, 1))).tolist()
+    myscale = quantile_scale(pd.concat([year1_data, year2_data]).Count)
 
     m1 = choropleth_plot(year1_data, myscale, category, [year1])
     m2 = choropleth_plot(year2_data, myscale, category, [year2])
 
-    m1.save(f'../html/Denver_{category}_choropleth_{year1}.html')
-    m2.save(f'../html/Denver_{category}_choropleth_{year2}.html')
+    for mapa, year in [(m1, year1), (m2, year2)]:
+        path = f'../html/Denver_{category}_choropleth_{year}.html'
+        with profile_functions.stage('folium_save', output=path):
+            mapa.save(path)
+
+
+def quantile_scale(counts, quantiles=(0, 0.3, 0.8, 0.965, 1)):
+    """ Returns the threshold_scale used for a category: the quantiles of the
+        neighborhood counts with repeated values dropped (sparse categories
+        often have several quantiles equal to each other), padded to the three
+        bins folium's ColorBrewer scales need at minimum (a category with no
+        counts gets the scale 0, 1, 2, 3)
+        Args:
+            counts: a pandas series of neighborhood counts across all maps sharing the scale
+            quantiles: the quantiles used as thresholds
+    """
+    scale = sorted(set(counts.dropna().quantile(quantiles).dropna().tolist())) or [0]
+    while len(scale) < 4:
+        scale.append(scale[-1] + 1)
+    return scale
+
+
+def _round_coordinates(coords, precision):
+    if isinstance(coords[0], (list, tuple)):
+        return [_round_coordinates(c, precision) for c in coords]
+    return [round(c, precision) for c in coords]
+
+
+@profiled()
+def write_neighborhood_asset(shape_df, counts, path=NEIGHBORHOOD_ASSET, tolerance=0.0001, precision=5):
+    """ Writes the neighborhood boundaries once as a GeoJSON file that every
+        map made by choropleth_plot_from_asset loads instead of embedding
+        Geometries are simplified to tolerance (degrees) and coordinates are
+        rounded to precision decimal places (5 is about a meter). Each feature
+        carries 'Neighborhood', 'id' and one count property per map.
+        Returns the path written
+        Args:
+            shape_df: pandas dataframe of cleaned .shp (see prepare_shapefile_dataframe function above)
+            counts: dataframe with columns 'Neighborhood', 'key' (the property name
+            for a map, e.g. 'auto-theft 2020') and 'Count'
+            path: where to write the GeoJSON file
+            tolerance: simplification tolerance in degrees (0 or None keeps every vertex)
+            precision: number of decimal places kept in coordinates
+    """
+    if shape_df.crs is not None and not shape_df.crs.equals('EPSG:4326'):
+        shape_df = shape_df.to_crs('EPSG:4326')
+    geometry = shape_df.geometry
+    if tolerance:
+        geometry = geometry.simplify(tolerance, preserve_topology=True)
+    geometry = shapely.set_precision(geometry.values, 10 ** -precision)
+
+    wide = (counts.pivot_table(index='Neighborhood', columns='key', values='Count', aggfunc='sum', observed=True)
+                  .reindex(shape_df['NBHD_NAME'])
+                  .fillna(0)
+                  .astype(int))
+    features = []
+    for (name, nbhd_id, geom), (_, row) in zip(zip(shape_df['NBHD_NAME'], shape_df['NBHD_ID'], geometry), wide.iterrows()):
+        mapping = shapely.geometry.mapping(geom)
+        features.append({'type': 'Feature',
+                         'properties': {'Neighborhood': name, 'id': int(nbhd_id), **row.to_dict()},
+                         'geometry': {'type': mapping['type'],
+                                      'coordinates': _round_coordinates(mapping['coordinates'], precision)}})
+
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with profile_functions.stage('write_geojson', output=path), open(path, 'w') as f:
+        json.dump({'type': 'FeatureCollection', 'features': features}, f, separators=(',', ':'))
+    return path
+
+
+def output_size_report(paths, embedded_bytes=None):
+    """ Returns a dataframe with the size in bytes of each file in paths
+        plus a 'total' row
+        Args:
+            paths: list of file paths (html maps and any shared assets)
+            embedded_bytes: optional dict of map path -> size in bytes of the
+            same map with its geometry embedded, added as an 'embedded_bytes'
+            column (0 for shared assets) so the before and after sizes can be
+            compared
+    """
+    report = pd.DataFrame({'path': paths, 'bytes': [os.path.getsize(p) for p in paths]})
+    if embedded_bytes is not None:
+        report['embedded_bytes'] = [embedded_bytes.get(p, 0) for p in paths]
+    total = report.drop(columns='path').sum().to_frame().T
+    total.insert(0, 'path', 'total')
+    return pd.concat([report, total], ignore_index=True)
+
+
+def _render_choropleth(data, myscale, category, year, embedded=None):
+    """ Renders and saves one choropleth map, returning (path, seconds, embedded bytes)
+        data is either a merged count dataframe or the path of a shared asset;
+        given embedded (the merged count dataframe for an asset map), the same
+        map is also rendered with embedded geometry, in memory only, to measure
+        its size (None otherwise)
+    """
+    start = time.perf_counter()
+    path = f'../html/Denver_{category}_choropleth_{year}.html'
+    if isinstance(data, str):
+        mapa = choropleth_plot_from_asset(data, f'{category} {year}', myscale, category, [year])
+    else:
+        mapa = choropleth_plot(data, myscale, category, [year])
+    with profile_functions.stage('folium_save', output=path):
+        mapa.save(path)
+    seconds = time.perf_counter() - start
+    embedded_bytes = None
+    if embedded is not None:
+        embedded_bytes = len(choropleth_plot(embedded, myscale, category, [year]).get_root().render().encode('utf8'))
+    return path, seconds, embedded_bytes
+
+
+@profiled()
+def choropleth_all_categories_and_years(denver_crime_df, categories=None, years=None, join='name',
+                                        simplify_tolerance=0.0001, processes=None, shared_asset=False,
+                                        compare_sizes=False):
+    """ Saves a choropleth map as an html file for every category and year
+        The shapefile is read and simplified once, the counts for every
+        category/year/neighborhood come from one grouped pass over the incidents,
+        each category gets one threshold_scale shared by all its years, and the
+        maps are rendered and saved across a process pool.
+        Returns a dataframe with the path and render time of every map (and,
+        with shared_asset and compare_sizes, its size with embedded geometry)
+        Args:
+            denver_crime_df: a pandas dataframe for denver crime
+            categories: list of categories to map (None maps every category)
+            years: list of years to map (None maps every year in the data)
+            join: 'name' or 'spatial', how incidents are matched to neighborhoods
+            (see create_denver_geodataframe)
+            simplify_tolerance: tolerance in degrees for simplifying the neighborhood
+            polygons before rendering (0 or None keeps full resolution)
+            processes: number of worker processes (None uses every core, 1 renders serially)
+            shared_asset: if True, write the (simplified, quantized) boundaries and
+            all counts once to NEIGHBORHOOD_ASSET and have every map load that file
+            instead of embedding the polygons (see choropleth_plot_from_asset)
+            compare_sizes: with shared_asset, also render every map with its
+            geometry embedded (in memory, not saved) and report the output size
+            before and after; this roughly doubles the rendering time, so it is
+            off by default
+    """
+    start = time.perf_counter()
+    shape_df = prepare_shapefile_dataframe()
+    if simplify_tolerance:
+        shape_df['geometry'] = shape_df.geometry.simplify(simplify_tolerance, preserve_topology=True)
+    geo_df = create_denver_geodataframe(denver_crime_df, shape_df, join=join)
+
+    if categories is not None:
+        geo_df = geo_df[geo_df['OFFENSE_CATEGORY_ID'].isin(categories)]
+    if years is not None:
+        geo_df = geo_df[geo_df['year'].isin(years)]
+    counts = (geo_df.groupby(['OFFENSE_CATEGORY_ID', 'year', 'NEIGHBORHOOD_ID'], observed=True)
+                    .size()
+                    .rename('Count')
+                    .reset_index()
+                    .rename(columns={'NEIGHBORHOOD_ID': 'Neighborhood'}))
+
+    if shared_asset:
+        counts['key'] = counts['OFFENSE_CATEGORY_ID'].astype(str) + ' ' + counts['year'].astype(str)
+        write_neighborhood_asset(shape_df, counts, tolerance=None)
+
+    jobs = []
+    for category, cat_counts in counts.groupby('OFFENSE_CATEGORY_ID', observed=True):
+        myscale = quantile_scale(cat_counts['Count'])
+        for year, year_counts in cat_counts.groupby('year'):
+            merged = merge_counts_with_shapes(shape_df, year_counts[['Neighborhood', 'Count']])
+            if shared_asset:
+                jobs.append((NEIGHBORHOOD_ASSET, myscale, category, year, merged if compare_sizes else None))
+            else:
+                jobs.append((merged, myscale, category, year))
+    print(f'Prepared {len(jobs)} maps in {time.perf_counter() - start:.1f}s')
+
+    results = []
+    if processes == 1:
+        for i, job in enumerate(jobs, 1):
+            path, seconds, embedded_bytes = _render_choropleth(*job)
+            results.append({'path': path, 'seconds': seconds, 'embedded_bytes': embedded_bytes})
+            print(f'[{i}/{len(jobs)}] {path} ({seconds:.1f}s)')
+    else:
+        with ProcessPoolExecutor(processes) as pool:
+            futures = [pool.submit(_render_choropleth, *job) for job in jobs]
+            for i, future in enumerate(as_completed(futures), 1):
+                path, seconds, embedded_bytes = future.result()
+                results.append({'path': path, 'seconds': seconds, 'embedded_bytes': embedded_bytes})
+                print(f'[{i}/{len(jobs)}] {path} ({seconds:.1f}s)')
+
+    results = pd.DataFrame(results, columns=['path', 'seconds', 'embedded_bytes'])
+    compared = shared_asset and compare_sizes
+    if not compared:
+        results = results.drop(columns='embedded_bytes')
+    paths = results.path.tolist() + ([NEIGHBORHOOD_ASSET] if shared_asset else [])
+    report = output_size_report(paths, dict(zip(results.path, results.embedded_bytes)) if compared else None)
+    total = report.iloc[-1]
+    print(f'Saved {len(results)} maps in {time.perf_counter() - start:.1f}s '
+          f'({results.seconds.sum():.1f}s of rendering, {total.bytes:,} bytes on disk)')
+    if compared:
+        print(f'Output size: {total.embedded_bytes:,} bytes with embedded geometry, {total.bytes:,} bytes with the '
+              f'shared asset ({1 - total.bytes / total.embedded_bytes:.0%} smaller)')
+    return results
@@ -1,32 +1,241 @@
+import os
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
 import seaborn as sns
 import folium_functions
 import choropleth_functions
-
-
-def capitalize_titles(string):
-    return ' '.join([x.capitalize() for x in string.split('-')])
+import ingest_functions
+import render_functions
+import schema_functions
+import aggregate_functions
+import fastplot_functions
+import backend_functions
+import profile_functions
+from profile_functions import profiled
+from normalize_functions import capitalize_titles, display_titles
+import normalize_functions
 
 
 class CrimeDataFrame():
 
-    def __init__(self, filename, dt_cols, format, date_col):
-        self.df = pd.read_csv(filename)
+    # years left out of every plot (2021 is only partially covered by the exports)
+    exclude_years = [2021]
+
+    @profiled('CrimeDataFrame.load')
+    def __init__(self, filename, dt_cols, format, date_col, cache_dir=None, columns=None, cache_format='parquet'):
+        """ Loads a crime csv, converts dt_cols to datetimes and adds year, month and week
+            Args:
+                filename: path of the crime csv
+                dt_cols: list of columns to convert to datetimes
+                format: the datetime format string for dt_cols
+                date_col: the column year, month and week are derived from
+                cache_dir: if given, the parsed dataframe is stored in (and on later
+                runs loaded from) a columnar cache file in this directory
+                columns: list of columns to keep (None keeps every column)
+                cache_format: 'parquet' or 'feather'
+        """
+        self._cubes = []
+        cache_file = None
+        if cache_dir is not None:
+            cache_file = ingest_functions.cache_path(filename, dt_cols, format, date_col, cache_dir, cache_format)
+            if os.path.exists(cache_file):
+                with profile_functions.stage('read_cache'):
+                    self.df = ingest_functions.read_cache(cache_file, columns)
+                return
+        with profile_functions.stage('read_csv') as stage:
+            self.df = pd.read_csv(filename)
+            stage.rows = len(self.df)
         self.convert_to_datetime(dt_cols, format)
         self.add_month_week_year(date_col)
-
+        if cache_file is not None:
+            with profile_functions.stage('write_cache', rows=len(self.df), output=cache_file):
+                self.df = ingest_functions.compact_dtypes(self.df)
+                ingest_functions.write_cache(self.df, cache_file)
+        if columns is not None:
+            self.df = self.df[columns]
+
+    @profiled('to_datetime')
     def convert_to_datetime(self, dt_cols, format):
         for col in dt_cols:
             self.df[col] = pd.to_datetime(self.df[col], format=format)
 
+    @profiled('date_parts')
     def add_month_week_year(self, date_col):
-        self.df['year'] = self.df[date_col].dt.year
-        self.df['month'] = self.df[date_col].dt.month
-        self.df['week'] = self.df[date_col].dt.isocalendar().week
-
-    def barplot_city_crime_by_category(self, offense_category_id, incident_id, city, palette="tab10"):
+        ingest_functions.add_date_parts(self.df, date_col)
+
+    @profiled()
+    def normalize_neighborhoods(self, neighborhood_id='NEIGHBORHOOD_ID', as_of=None, date_col=None):
+        """ Applies the neighborhood renames (e.g. stapleton -> central-park, see
+            normalize_functions.NEIGHBORHOOD_RENAMES) to the neighborhood column,
+            storing it as a categorical; the renames are applied once per distinct
+            neighborhood rather than per row
+            Args:
+                neighborhood_id: name of the column identifying the neighborhood
+                as_of: only apply renames effective on or before this date
+                (None applies every rename)
+                date_col: if given, each rename is only applied to incidents
+                dated (by this column) on or after it took effect, keeping the
+                historical names (None renames every year)
+        """
+        dates = self.df[date_col] if date_col else None
+        self.df[neighborhood_id] = normalize_functions.rename_neighborhoods(self.df[neighborhood_id], as_of, dates)
+        self._cubes = [cube for cube in self._cubes if cube.neighborhood_id != neighborhood_id]
+
+    @classmethod
+    @profiled('CrimeDataFrame.from_csv_chunks')
+    def from_csv_chunks(cls, filename, dt_cols, format, date_col, usecols=ingest_functions.PLOT_COLUMNS,
+                        dtype=None, chunksize=200000):
+        """ Streaming constructor: reads the csv in bounded chunks keeping only
+            usecols, so peak memory stays close to the size of the compact result
+            Prints rows/sec and peak resident memory once loading is done.
+            Args:
+                filename: path of the crime csv
+                dt_cols: list of columns to convert to datetimes
+                format: the datetime format string for dt_cols
+                date_col: the column year, month and week are derived from
+                usecols: list of columns to read besides dt_cols and date_col
+                (None reads every column, those the file lacks are skipped)
+                dtype: dict of column name to dtype passed to pd.read_csv
+                chunksize: number of rows parsed at a time
+        """
+        crime = cls.__new__(cls)
+        crime._cubes = []
+        crime.df, crime.load_stats = ingest_functions.read_csv_chunked(filename, dt_cols, format, date_col,
+                                                                       usecols, dtype, chunksize)
+        print(f"Read {crime.load_stats['rows']:,} rows in {crime.load_stats['seconds']:.1f}s "
+              f"({crime.load_stats['rows_per_sec']:,.0f} rows/sec), peak RSS {crime.load_stats['peak_rss_mb']:.0f} MB")
+        return crime
+
+    @classmethod
+    @profiled('CrimeDataFrame.from_cities')
+    def from_cities(cls, cities, filenames=None):
+        """ Loads one or more cities registered in schema_functions.SCHEMAS into a
+            single canonical dataframe (Denver column names, categorical labels,
+            a 'city' column), reading only the mapped columns
+            Args:
+                cities: list of city names, e.g. ['Denver', 'Seattle']
+                filenames: optional dict of city -> csv path overriding the registered ones
+        """
+        crime = cls.__new__(cls)
+        crime._cubes = []
+        crime.df = schema_functions.load_cities(cities, filenames)
+        return crime
+
+    def city_counts(self, by, offense_category_id='OFFENSE_CATEGORY_ID'):
+        """ Returns incident counts per city grouped by by (dimensions of
+            aggregate_functions.CountCube other than 'neighborhood'), from a count
+            cube whose neighborhood axis is the 'city' column
+            Args:
+                by: list of dimensions, e.g. ['category', 'year']
+                offense_category_id: name of the column that categorizes the offense
+        """
+        return (self.count_cube(offense_category_id, 'city')
+                    .counts(['neighborhood'] + list(by), exclude_years=self.exclude_years)
+                    .rename(columns={'neighborhood': 'city'}))
+
+    def count_cube(self, offense_category_id=None, neighborhood_id=None):
+        """ Returns the memoized CountCube (see aggregate_functions) for the
+            category and neighborhood columns, building it on first use
+            A cube already built over the same category column is reused, so one
+            scan of the raw data serves every plot. Columns not given default to
+            OFFENSE_CATEGORY_ID and NEIGHBORHOOD_ID when the dataframe has them.
+            Args:
+                offense_category_id: name of the column that categorizes the offense
+                neighborhood_id: name of the column identifying the neighborhood
+        """
+        for cube in self._cubes:
+            if ((offense_category_id is None or cube.offense_category_id == offense_category_id)
+                    and (neighborhood_id is None or cube.neighborhood_id == neighborhood_id)):
+                return cube
+        if offense_category_id is None and 'OFFENSE_CATEGORY_ID' in self.df.columns:
+            offense_category_id = 'OFFENSE_CATEGORY_ID'
+        if neighborhood_id is None and 'NEIGHBORHOOD_ID' in self.df.columns:
+            neighborhood_id = 'NEIGHBORHOOD_ID'
+        with profile_functions.stage('CountCube', rows=len(self.df)):
+            cube = aggregate_functions.CountCube(self.df, offense_category_id, neighborhood_id)
+        self._cubes.append(cube)
+        return cube
+
+    @profiled()
+    def append_export(self, filename, dt_cols, format, date_col, key='INCIDENT_ID', store=None):
+        """ Folds a newly published export into self.df without reprocessing the
+            full history: only incidents that are new, or whose rows differ from
+            the stored ones (revised records), are replaced, and memoized count
+            cubes are updated by the difference
+            Returns a dict describing the change: the number of 'new' and 'revised'
+            incidents and the sets of 'categories', 'neighborhoods' and 'years'
+            touched (see refresh_outputs)
+            Args:
+                filename: path of the new export csv
+                dt_cols: list of columns to convert to datetimes
+                format: the datetime format string for dt_cols
+                date_col: the column year, month and week are derived from
+                key: the incident identifier column
+                store: if given, path of a parquet/feather file the updated
+                dataframe is written to
+        """
+        usecols = [col for col in self.df.columns if col not in ingest_functions.DATE_PART_DTYPES]
+        categorical_cols = [col for col in usecols if isinstance(self.df[col].dtype, pd.CategoricalDtype)]
+        export, _ = ingest_functions.read_csv_chunked(filename, dt_cols, format, date_col, usecols=usecols,
+                                                      categorical_cols=categorical_cols)
+        removed, added = ingest_functions.diff_export(self.df, export, key)
+
+        kept = self.df[~self.df[key].isin(removed[key].unique())]
+        self.df = ingest_functions.concat_frames([kept, added[self.df.columns]])
+        for i, cube in enumerate(self._cubes):
+            if not cube.apply_delta(removed, added):
+                self._cubes[i] = aggregate_functions.CountCube(self.df, cube.offense_category_id, cube.neighborhood_id)
+        if store is not None:
+            ingest_functions.write_cache(self.df, store)
+
+        touched = pd.concat([removed, added[removed.columns]], ignore_index=True)
+        changes = {'new': int(added.loc[~added[key].isin(removed[key]), key].nunique()),
+                   'revised': int(removed[key].nunique()),
+                   'years': set(touched['year'].dropna().astype(int))}
+        for name, column in [('categories', 'OFFENSE_CATEGORY_ID'), ('neighborhoods', 'NEIGHBORHOOD_ID')]:
+            changes[name] = set(touched[column].dropna()) if column in touched.columns else set()
+        return changes
+
+    @profiled()
+    def refresh_outputs(self, changes, city, offense_category_id='OFFENSE_CATEGORY_ID', first_offense_date='FIRST_OCCURRENCE_DATE',
+                        incident_id='INCIDENT_ID', neighborhood_id='NEIGHBORHOOD_ID', maps=True, palette="tab10"):
+        """ Regenerates only the figures and maps whose inputs changed
+            (changes as returned by append_export)
+            The all-category figures are redrawn when a plotted year changed,
+            each changed category with incidents in the plotted years gets its
+            double_plot redrawn, the top neighborhoods chart is redrawn when
+            neighborhoods changed, and the choropleth maps of changed
+            categories are rebuilt for all years since they share one colour
+            scale.
+            Args:
+                changes: dict returned by append_export
+                city: a string specifying the name of the city
+                offense_category_id: the name of the column that categorizes the offense
+                first_offense_date: the name of the column where the date of first offense is
+                incident_id: the name of the column where the incident identifier is
+                neighborhood_id: the name of the column identifying the neighborhood
+                maps: whether to rebuild the Denver choropleth maps
+                palette: seaborn color palette for the category barplot
+        """
+        plotted_years = changes['years'] - set(self.exclude_years)
+        if plotted_years:
+            self.barplot_city_crime_by_category(offense_category_id, incident_id, city, palette)
+            self.lineplot_all_cats_over_time(offense_category_id, first_offense_date, incident_id, city)
+            self.boxplots_by_cat(offense_category_id, city)
+            self.kdeplots_by_cat(offense_category_id, city)
+            plotted = set(self.count_cube(offense_category_id).category_labels(exclude_years=self.exclude_years))
+            for category in sorted(changes['categories'] & plotted):
+                self.double_plot(category, offense_category_id, first_offense_date, incident_id, city)
+                plt.close('all')
+            if changes['neighborhoods']:
+                self.top_crime_neighborhoods(15, neighborhood_id, city)
+            plt.close('all')
+        if maps and changes['categories']:
+            choropleth_functions.choropleth_all_categories_and_years(self.df, categories=sorted(changes['categories']))
+
+    @profiled()
+    def barplot_city_crime_by_category(self, offense_category_id, incident_id, city, palette="tab10", backend=None):
         """ Barplot of # of incidents by category by year
             Args:
                 offense_category_id: a string specifying the name of the column
@@ -37,13 +246,20 @@ class CrimeDataFrame():
 
                 city: a string specifying the name of the city
                 palette: seaborn color palette for plot
+                backend: a backend_functions count backend (e.g.
+                get_backend('duckdb') over the city/year partitions) to count
+                with instead of the in-memory count cube
         """
         fig, ax = plt.subplots(figsize=(18, 10))
         sns.set_palette(palette)
-        cat_by_year = (self.df.groupby(['year', offense_category_id])
-                              .agg({incident_id: 'count'})
-                              .reset_index())
-        data = cat_by_year[cat_by_year.year != 2021].sort_values(incident_id, ascending=False)
+        if backend is None:
+            cat_by_year = (self.count_cube(offense_category_id)
+                               .counts(['year', 'category'], exclude_years=self.exclude_years)
+                               .rename(columns={'category': offense_category_id, 'count': incident_id}))
+        else:
+            cat_by_year = (backend_functions.category_counts_by_year(backend, offense_category_id, self.exclude_years, city)
+                               .rename(columns={'INCIDENT_ID': incident_id}))
+        data = cat_by_year.sort_values(incident_id, ascending=False)
         ax = sns.barplot(x=offense_category_id, y=incident_id, hue='year', data=data, saturation=0.7, alpha=0.9, edgecolor='black')
         ax.set_yticklabels([int(x) for x in ax.get_yticks()], size=20)
         plt.ylabel('# of Occurences Per Year', size=22)
@@ -53,7 +269,9 @@ class CrimeDataFrame():
         plt.xticks(rotation=30, ha='right', fontsize=18)
         plt.tight_layout()
         plt.legend(fontsize='xx-large')
-        fig.savefig(f'../images/{city}/{city}CrimeByCategoryBarplot.png')
+        path = f'../images/{city}/{city}CrimeByCategoryBarplot.png'
+        with profile_functions.stage('savefig', output=path):
+            fig.savefig(path)
 
     def lineplot_specific_category_over_time(self, ax, specific_category, offense_category_id, first_offense_date, incident_id):
         """ Lineplot of # of incidents per month over time for specified category
@@ -72,12 +290,9 @@ class CrimeDataFrame():
                 incident_id: a string specifying the name of the column
                 where the incident identifier is
         """
-        cat_df = self.df[self.df[offense_category_id] == specific_category].copy()
-        cat_df = cat_df[cat_df.year != 2021]
-        cat_df = (cat_df.groupby(['year', 'month'])
-                        .agg({incident_id: 'count'})
-                        .rename(columns={incident_id: 'incident_count'})
-                        .reset_index())
+        cat_df = (self.count_cube(offense_category_id)
+                      .counts(['year', 'month'], categories=[specific_category], exclude_years=self.exclude_years)
+                      .rename(columns={'count': 'incident_count'}))
 
         n = max(cat_df.year) - min(cat_df.year) + 1
         ax.set_prop_cycle('color', [plt.cm.bone(i) for i in np.linspace(0, 0.8, n)][::-1])
@@ -97,6 +312,7 @@ class CrimeDataFrame():
         ax.yaxis.set_tick_params(labelsize=18)
         ax.legend(title='year')
 
+    @profiled()
     def lineplot_all_cats_over_time(self, offense_category_id, first_offense_date, incident_id, city):
         """ Lineplots of # of incidents per month over time by category
             Args:
@@ -111,7 +327,7 @@ class CrimeDataFrame():
 
                 city: a string specifying the name of the city
         """
-        categories = self.df[offense_category_id].unique()
+        categories = self.count_cube(offense_category_id).category_labels(exclude_years=self.exclude_years)
         num_rows = int(np.ceil(len(categories)/2))
         fig, axes = plt.subplots(num_rows, 2, figsize=(18, num_rows*8))
         for category, ax in zip(categories, axes.flatten()):
@@ -120,9 +336,12 @@ class CrimeDataFrame():
             axes.flatten()[-1].axis('off')
         fig.suptitle(f'{city} Crime over Time', x=0.5, y=1.01, fontsize=35, fontweight='bold')
         plt.tight_layout()
-        fig.savefig(f'../images/{city}/{city}_Crime_over_Time.png', bbox_inches='tight')
+        path = f'../images/{city}/{city}_Crime_over_Time.png'
+        with profile_functions.stage('savefig', output=path):
+            fig.savefig(path, bbox_inches='tight')
 
-    def boxplots_by_cat(self, offense_category_id, city):
+    @profiled()
+    def boxplots_by_cat(self, offense_category_id, city, fast=None):
         """ Plots a swarmplot overlaying boxplot showing the distribution
             across timevfor each unique category in the columns passed as
             offense_category_id
@@ -132,23 +351,31 @@ class CrimeDataFrame():
                 name of the column that categorizes the offense
 
                 city: a string specifying the name of the city
+
+                fast: True draws the swarm with the vectorized beeswarm in
+                fastplot_functions, False with seaborn, None picks by point count
         """
-        box_df = self.df[self.df.year != 2021].copy()
-        categories = box_df[offense_category_id].unique()
+        cube = self.count_cube(offense_category_id)
+        categories = cube.category_labels(exclude_years=self.exclude_years)
+        first_year, last_year = cube.year_range(exclude_years=self.exclude_years)
         fig, axes = plt.subplots(len(categories), 1, figsize=(12, 4*len(categories)))
-        for category, ax in zip(categories, axes.flatten()):
-            gtmp = (box_df[box_df[offense_category_id] == category].groupby(['year', 'week'])
-                                                                   .agg({'INCIDENT_ID': 'count'})
-                                                                   .rename(columns={'INCIDENT_ID': 'num_of_incidents'})
-                                                                   .reset_index())
+        for category, title, ax in zip(categories, display_titles(categories), axes.flatten()):
+            gtmp = (cube.counts(['year', 'week'], categories=[category], exclude_years=self.exclude_years)
+                        .rename(columns={'count': 'num_of_incidents'}))
             f = sns.boxplot(x='year', y='num_of_incidents', data=gtmp, boxprops=dict(alpha=0.25), ax=ax)
-            f = sns.swarmplot(x='year', y='num_of_incidents', data=gtmp, size=4, ax=ax)
+            if fastplot_functions.use_fast_path(fast, len(gtmp)):
+                fastplot_functions.swarmplot(gtmp, 'year', 'num_of_incidents', ax, size=4)
+            else:
+                f = sns.swarmplot(x='year', y='num_of_incidents', data=gtmp, size=4, ax=ax)
             f.set(xlabel='Year', ylabel='Number of Incidents Per Week')
-            f.set_title(f'Distribution of {capitalize_titles(category)} Per Week From {min(box_df.year)} - {max(box_df.year)}')
-            plt.tight_layout()
-            fig.savefig(f'../images/{city}/{city}_Boxswarm_By_Cat.png')
+            f.set_title(f'Distribution of {title} Per Week From {first_year} - {last_year}')
+        plt.tight_layout()
+        path = f'../images/{city}/{city}_Boxswarm_By_Cat.png'
+        with profile_functions.stage('savefig', output=path):
+            fig.savefig(path)
 
-    def kdeplots_by_cat(self, offense_category_id, city):
+    @profiled()
+    def kdeplots_by_cat(self, offense_category_id, city, fast=None):
         """ On the same graph, for each year, a kernel density estimate
             plot of the distribution of the number incidents for a
             category is plotted. One such graph is generated for
@@ -159,22 +386,29 @@ class CrimeDataFrame():
                 of the column that categorizes the offense
 
                 city: a string specifying the name of the city
+
+                fast: True computes the KDEs with the binned FFT estimator in
+                fastplot_functions, False with seaborn, None picks by point count
         """
-        df = self.df[self.df.year != 2021].copy()
+        cube = self.count_cube(offense_category_id)
         palette = sns.color_palette("rocket_r", as_cmap=True)
-        categories = df[offense_category_id].unique()
+        categories = cube.category_labels(exclude_years=self.exclude_years)
         fig, axes = plt.subplots(len(categories), 1, figsize=(12, 3*len(categories)))
-        for category, ax in zip(categories, axes.flatten()):
-            gtmp = (df[df[offense_category_id] == category].groupby(['year', 'week'])
-                                                           .agg({'INCIDENT_ID': 'count'})
-                                                           .rename(columns={'INCIDENT_ID': 'num_of_incidents'})
-                                                           .reset_index())
-            g = sns.kdeplot(data=gtmp, x='num_of_incidents', hue='year', fill=True, palette=palette, ax=ax)
-            g.set_title(f'KDE of the Number of {capitalize_titles(category)} Per Week')
-            g.set_xlabel(f'Number of {capitalize_titles(category)} Per Week')
+        for category, title, ax in zip(categories, display_titles(categories), axes.flatten()):
+            gtmp = (cube.counts(['year', 'week'], categories=[category], exclude_years=self.exclude_years)
+                        .rename(columns={'count': 'num_of_incidents'}))
+            if fastplot_functions.use_fast_path(fast, len(gtmp), fastplot_functions.FAST_KDE_THRESHOLD):
+                g = fastplot_functions.kdeplot(gtmp, 'num_of_incidents', 'year', palette, ax)
+            else:
+                g = sns.kdeplot(data=gtmp, x='num_of_incidents', hue='year', fill=True, palette=palette, ax=ax)
+            g.set_title(f'KDE of the Number of {title} Per Week')
+            g.set_xlabel(f'Number of {title} Per Week')
         plt.tight_layout()
-        fig.savefig(f'../images/{city}/{city}_KDEplots_By_Cat.png')
+        path = f'../images/{city}/{city}_KDEplots_By_Cat.png'
+        with profile_functions.stage('savefig', output=path):
+            fig.savefig(path)
 
+    @profiled()
     def top_crime_neighborhoods(self, n, neighborhood_id, city):
         """ A barchart of the top n neighborhoods ranked by highest crime counts
             Args:
@@ -183,20 +417,26 @@ class CrimeDataFrame():
                 city: a string specigying the name of the city
         """
         fig, ax = plt.subplots(figsize=(9, max(n//3, 1)))
-        tmp = self.df[(self.df.year != 2021) & (self.df[neighborhood_id] != 'cbd')]
-        neighborhood = tmp.groupby(neighborhood_id).size().sort_values(ascending=False).reset_index()
-        neighborhood.rename(columns={neighborhood_id: 'Neighborhood', 0: 'Count'}, inplace=True)
+        cube = self.count_cube(neighborhood_id=neighborhood_id)
+        first_year, last_year = cube.year_range(exclude_years=self.exclude_years)
+        neighborhood = cube.counts(['neighborhood'], exclude_years=self.exclude_years)
+        neighborhood = (neighborhood[neighborhood.neighborhood != 'cbd']
+                        .sort_values('count', ascending=False)
+                        .rename(columns={'neighborhood': 'Neighborhood', 'count': 'Count'}))
         top_n = neighborhood[:n]
+        top_n = top_n.assign(Neighborhood=display_titles(top_n['Neighborhood']).astype(str))
         g = sns.barplot(x='Count', y='Neighborhood', data=top_n, palette='mako', edgecolor='black')
-        g.axes.set_title(f"Neighborhoods in {city} with Most Crime From {min(tmp.year)}-{max(tmp.year)}", fontsize=16)
+        g.axes.set_title(f"Neighborhoods in {city} with Most Crime From {first_year}-{last_year}", fontsize=16)
         g.set_xlabel("Number of Crime Occurrences", fontsize=12)
         g.set_ylabel("")
-        g.set_yticklabels([capitalize_titles(y.get_text()) for y in g.get_yticklabels()])
         g.tick_params(labelsize=11)
         plt.tight_layout()
-        fig.savefig(f'../images/{city}/{city}TopNCrimeNeighborhoods.png')
+        path = f'../images/{city}/{city}TopNCrimeNeighborhoods.png'
+        with profile_functions.stage('savefig', output=path):
+            fig.savefig(path)
 
-    def double_plot(self, category, offense_category_id, first_offense_date, incident_id, city):
+    @profiled()
+    def double_plot(self, category, offense_category_id, first_offense_date, incident_id, city, fast=None):
         """ Two plots
                     - Left plot is a lineplot of # of incidents over time
                     - Right plot is boxplot/swarmplot of the distribution # incidents over time
@@ -210,12 +450,14 @@ class CrimeDataFrame():
                 the column where the date of first offense is
 
                 city: a string specifying the name of the city
+
+                fast: True draws the swarm with the vectorized beeswarm in
+                fastplot_functions, False with seaborn, None picks by point count
         """
         fig, axes = plt.subplots(1, 2, figsize=(16, 6), sharey=True)
-        cat_gp = (self.df[(self.df[offense_category_id] == category) & (self.df.year != 2021)].groupby(['year', 'month'])
-                                                                                              .agg({incident_id: 'count'})
-                                                                                              .rename(columns={incident_id: 'num_of_incidents'})
-                                                                                              .reset_index())
+        cat_gp = (self.count_cube(offense_category_id)
+                      .counts(['year', 'month'], categories=[category], exclude_years=self.exclude_years)
+                      .rename(columns={'count': 'num_of_incidents'}))
 
         self.lineplot_specific_category_over_time(axes[0], category, offense_category_id, first_offense_date, incident_id)
 
@@ -223,13 +465,18 @@ class CrimeDataFrame():
         colors = [plt.cm.bone(i) for i in np.linspace(0, 0.9, 5)][::-1]
         colors.append('red')
         f = sns.boxplot(x='year', y='num_of_incidents', data=cat_gp, boxprops=dict(alpha=0.25), ax=axes[1], palette=colors[1:])
-        f = sns.swarmplot(x='year', y='num_of_incidents', data=cat_gp, size=6, ax=axes[1], palette=colors[1:])
+        if fastplot_functions.use_fast_path(fast, len(cat_gp)):
+            fastplot_functions.swarmplot(cat_gp, 'year', 'num_of_incidents', axes[1], size=6, palette=colors[1:])
+        else:
+            f = sns.swarmplot(x='year', y='num_of_incidents', data=cat_gp, size=6, ax=axes[1], palette=colors[1:])
         f.set_xlabel('Year', fontsize=18)
         f.set_ylabel('', fontsize=18)
         f.tick_params(labelsize=18)
         f.axes.set_title(f"Distribution of Monthly {capitalize_titles(category)} Incidents", fontsize=18)
         plt.tight_layout()
-        fig.savefig(f'../images/{city}/{city}_{category}_Over_Time.png')
+        path = f'../images/{city}/{city}_{category}_Over_Time.png'
+        with profile_functions.stage('savefig', output=path):
+            fig.savefig(path)
 
 
 if __name__ == '__main__':
@@ -240,8 +487,11 @@ if __name__ == '__main__':
         Makes choropleth maps for Denver for auto-theft in 2020 and 2019
         Left for ease of generating graphics
     """
-    # Denver = CrimeDataFrame('../data/denver_crime.csv', ['FIRST_OCCURRENCE_DATE', 'LAST_OCCURRENCE_DATE', 'REPORTED_DATE'], "%m/%d/%Y %I:%M:%S %p", 'FIRST_OCCURRENCE_DATE')
+    # Run with CRIME_PROFILE=1 to print per stage timings, rows, memory and output
+    # sizes at exit and write a JSON trace (see profile_functions).
+    # Denver = CrimeDataFrame('../data/denver_crime.csv', ['FIRST_OCCURRENCE_DATE', 'LAST_OCCURRENCE_DATE', 'REPORTED_DATE'], "%m/%d/%Y %I:%M:%S %p", 'FIRST_OCCURRENCE_DATE', cache_dir=ingest_functions.CACHE_DIR)
 
+    # Denver.normalize_neighborhoods()
     # Denver.lineplot_all_cats_over_time('OFFENSE_CATEGORY_ID','FIRST_OCCURRENCE_DATE', 'INCIDENT_ID', 'Denver')
     # Denver.barplot_city_crime_by_category('OFFENSE_CATEGORY_ID', 'INCIDENT_ID', 'Denver', ["#1D3557","#457B9D","#A8DADC","#F3C6C6","#E63946"])
     # Denver.boxplots_by_cat('OFFENSE_CATEGORY_ID', 'Denver')
@@ -251,9 +501,15 @@ if __name__ == '__main__':
     # for cat in categories:
     #    Denver.double_plot(cat, 'OFFENSE_CATEGORY_ID','FIRST_OCCURRENCE_DATE', 'INCIDENT_ID', 'Denver')
 
+    # Or render the same figure set across a process pool:
+    # render_functions.render_figures({'Denver': Denver}, render_functions.denver_figure_jobs(categories))
+
     # categories.remove('sexual-assault')
-    # folium_functions.make_layered_clustered_map(Denver.df, [39.7177, -104.9208], categories, 'OFFENSE_CATEGORY_ID', 'GEO_LAT', 'GEO_LON', 'Denver')
+    # folium_functions.make_layered_clustered_map(Denver.df, [39.7177, -104.9208], categories, 'OFFENSE_CATEGORY_ID', 'GEO_LAT', 'GEO_LON', 'Denver', fast=True)
     # choropleth_functions.choropleth_compare_two_years(Denver.df, 'auto-theft', 2020, 2019)
+    # choropleth_functions.choropleth_all_categories_and_years(Denver.df, years=[2016, 2017, 2018, 2019, 2020])
+    # Or browse every category and year from one locally served page:
+    # python service_functions.py serve
 
     """ Creates class with Seattle dataset attribute
         Makes top 10 crime neighborhoods plot
@@ -261,6 +517,14 @@ if __name__ == '__main__':
     """
     # Seattle = CrimeDataFrame('../data/Seattle_crime.csv', ['Offense Start DateTime'], '%m/%d/%Y %I:%M:%S %p', 'Offense Start DateTime')
 
+    # Or load both cities side by side in the canonical (Denver named) schema:
+    # Cities = CrimeDataFrame.from_cities(['Denver', 'Seattle'])
+    # Cities.city_counts(['category', 'year'])
+    # Or partition them by city/year on disk and count across cores without loading them:
+    # backend_functions.write_partitions(Cities.df)
+    # backend_functions.category_counts_by_year(backend_functions.get_backend('duckdb'), city='Seattle')
+    # Denver.barplot_city_crime_by_category('OFFENSE_CATEGORY_ID', 'INCIDENT_ID', 'Denver', backend=backend_functions.get_backend('duckdb'))
+
     # Seattle.top_crime_neighborhoods(10, 'MCPP', 'Seattle')
 
     # tmp = Seattle.df[Seattle.df.year == 2020][['Latitude','Longitude','Offense Parent Group']].dropna(axis=0)
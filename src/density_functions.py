@@ -0,0 +1,238 @@
+import os
+import json
+import shutil
+import numpy as np
+import pandas as pd
+import folium
+from branca.element import MacroElement
+from jinja2 import Template
+
+
+DENSITY_DIR = '../html/density'
+
+# Each map tile is split into 2**BIN_BITS x 2**BIN_BITS density cells
+BIN_BITS = 5
+
+# Each density file holds a block of 2**BLOCK_BITS x 2**BLOCK_BITS cells
+# (4 x 4 map tiles), so a view needs a handful of small files
+BLOCK_BITS = 7
+
+
+def tile_cells(lat, lon, level):
+    """ Returns integer (x, y) web mercator cell indices of points at a level,
+        where a level has 2**level cells along each side of the world
+        Args:
+            lat: array of latitudes
+            lon: array of longitudes
+            level: the cell level (zoom + BIN_BITS for cells of a zoom's tiles)
+    """
+    lat = np.radians(np.clip(np.asarray(lat, dtype=float), -85.0511, 85.0511))
+    lon = np.asarray(lon, dtype=float)
+    n = 2 ** level
+    x = np.floor((lon + 180) / 360 * n)
+    y = np.floor((1 - np.log(np.tan(lat) + 1 / np.cos(lat)) / np.pi) / 2 * n)
+    return np.clip(x, 0, n - 1).astype(np.int64), np.clip(y, 0, n - 1).astype(np.int64)
+
+
+def build_density_pyramid(df, offense_category_id, geo_lat, geo_lon, min_zoom=10, max_zoom=16):
+    """ Returns a dict of zoom -> dataframe of incident counts per density cell
+        (columns 'category', 'year', 'x', 'y', 'count')
+        Points are binned once at max_zoom; every coarser zoom is built from the
+        zoom above it by halving the cell indices, so the cost is one pass over
+        the incidents plus one pass over the (much fewer) occupied cells per zoom.
+        Rows without coordinates are skipped.
+        Args:
+            df: pandas crime dataframe with a year column
+            offense_category_id: the name of the column that categorizes the offense
+            geo_lat: the name of the column with the latitude coordinate
+            geo_lon: the name of the column with the longitude coordinate
+            min_zoom: coarsest zoom level built
+            max_zoom: finest zoom level built
+    """
+    df = df[df[geo_lat].notnull() & df[geo_lon].notnull() & df['year'].notnull()]
+    x, y = tile_cells(df[geo_lat], df[geo_lon], max_zoom + BIN_BITS)
+    cells = pd.DataFrame({'category': df[offense_category_id].to_numpy(),
+                          'year': df['year'].to_numpy(dtype=np.int64),
+                          'x': x, 'y': y})
+    level = cells.groupby(['category', 'year', 'x', 'y'], observed=True).size().rename('count').reset_index()
+    pyramid = {max_zoom: level}
+    for zoom in range(max_zoom - 1, min_zoom - 1, -1):
+        level = level.assign(x=level['x'] // 2, y=level['y'] // 2)
+        level = level.groupby(['category', 'year', 'x', 'y'], observed=True)['count'].sum().reset_index()
+        pyramid[zoom] = level
+    return pyramid
+
+
+def update_density_pyramid(pyramid, new_df, offense_category_id, geo_lat, geo_lon):
+    """ Returns pyramid with the incidents in new_df (e.g. a newly published
+        month) added, without rebinning the incidents already counted
+        Args:
+            pyramid: a dict built by build_density_pyramid
+            new_df: pandas crime dataframe of the new incidents only
+            offense_category_id: the name of the column that categorizes the offense
+            geo_lat: the name of the column with the latitude coordinate
+            geo_lon: the name of the column with the longitude coordinate
+    """
+    delta = build_density_pyramid(new_df, offense_category_id, geo_lat, geo_lon, min(pyramid), max(pyramid))
+    return {zoom: (pd.concat([pyramid[zoom], delta[zoom]], ignore_index=True)
+                     .groupby(['category', 'year', 'x', 'y'], observed=True)['count'].sum()
+                     .reset_index())
+            for zoom in pyramid}
+
+
+def write_density_tiles(pyramid, out_dir=DENSITY_DIR):
+    """ Writes the cells of each zoom, category and year split into blocks of
+        2**BLOCK_BITS x 2**BLOCK_BITS cells ({zoom}/{category index}/{year}/{bx}_{by}.json),
+        so DensityLayer only downloads the blocks in view, plus an index.json
+        listing the zooms, categories, years and the largest cell count of each
+        zoom, category and year
+        Each cell is stored as [x, y, count] with x and y relative to its block.
+        Zoom folders already in out_dir are replaced.
+        Returns the list of paths written
+        Args:
+            pyramid: a dict built by build_density_pyramid
+            out_dir: folder the files are written to
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    categories = sorted(set().union(*(level['category'].unique() for level in pyramid.values())))
+    years = sorted(set().union(*(level['year'].unique().tolist() for level in pyramid.values())))
+    lookup = {category: i for i, category in enumerate(categories)}
+    size = 2 ** BLOCK_BITS
+    paths = []
+    maxima = {}
+    for zoom, level in pyramid.items():
+        shutil.rmtree(os.path.join(out_dir, str(zoom)), ignore_errors=True)
+        level = level.assign(category=level['category'].map(lookup).astype(np.int64),
+                             bx=level['x'] // size, by=level['y'] // size)
+        maxima[zoom] = {}
+        for (category, year), cells in level.groupby(['category', 'year']):
+            maxima[zoom].setdefault(int(category), {})[int(year)] = int(cells['count'].max())
+            folder = os.path.join(out_dir, str(zoom), str(category), str(year))
+            os.makedirs(folder, exist_ok=True)
+            for (bx, by), block in cells.groupby(['bx', 'by']):
+                rows = np.column_stack([block['x'] - bx * size, block['y'] - by * size, block['count']])
+                path = os.path.join(folder, f'{bx}_{by}.json')
+                with open(path, 'w') as f:
+                    json.dump(rows.tolist(), f, separators=(',', ':'))
+                paths.append(path)
+    path = os.path.join(out_dir, 'index.json')
+    with open(path, 'w') as f:
+        json.dump({'zooms': sorted(pyramid), 'bin_bits': BIN_BITS, 'block_bits': BLOCK_BITS,
+                   'categories': [str(c) for c in categories], 'years': years, 'max': maxima}, f)
+    paths.append(path)
+    return paths
+
+
+class DensityLayer(MacroElement):
+    """ Folium layer drawing incident density cells from the files written by
+        write_density_tiles; after each move or zoom only the blocks of the
+        drawn category and year in view at the current zoom are fetched, and
+        blocks are cached in the browser afterwards
+        Args:
+            url: url (relative to the saved html) of the folder holding the files
+            category: the category to draw
+            year: the year to draw
+            zooms: the zoom levels available in the folder
+    """
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+        (function () {
+            var map = {{ this._parent.get_name() }};
+            var url = {{ this.url|tojson }};
+            var zooms = {{ this.zooms|tojson }};
+            var category = {{ this.category|tojson }};
+            var year = {{ this.year|tojson }};
+            var renderer = L.canvas();
+            var layer = L.layerGroup().addTo(map);
+            var blocks = {};
+            var index = null;
+            var pending = 0;
+
+            function cellLatLng(x, y, n) {
+                var lat = Math.atan(Math.sinh(Math.PI * (1 - 2 * y / n))) * 180 / Math.PI;
+                return [lat, x / n * 360 - 180];
+            }
+
+            function cellIndex(latlng, n) {
+                var lat = Math.max(-85.0511, Math.min(85.0511, latlng.lat)) * Math.PI / 180;
+                var x = Math.floor((latlng.lng + 180) / 360 * n);
+                var y = Math.floor((1 - Math.log(Math.tan(lat) + 1 / Math.cos(lat)) / Math.PI) / 2 * n);
+                return [Math.max(0, Math.min(n - 1, x)), Math.max(0, Math.min(n - 1, y))];
+            }
+
+            function fetchBlock(path) {
+                if (!blocks[path]) {
+                    blocks[path] = fetch(url + '/' + path)
+                        .then(function (r) { return r.ok ? r.json() : []; })
+                        .catch(function () { return []; });
+                }
+                return blocks[path];
+            }
+
+            function load() {
+                var request = ++pending;
+                var zoom = Math.max(zooms[0], Math.min(zooms[zooms.length - 1], Math.round(map.getZoom())));
+                var target = index.categories.indexOf(category);
+                var max = ((index.max[zoom] || {})[target] || {})[year];
+                if (!max) { layer.clearLayers(); return; }
+                var n = Math.pow(2, zoom + index.bin_bits);
+                var size = Math.pow(2, index.block_bits);
+                var bounds = map.getBounds();
+                var low = cellIndex(bounds.getNorthWest(), n), high = cellIndex(bounds.getSouthEast(), n);
+                var requests = [];
+                for (var bx = Math.floor(low[0] / size); bx <= Math.floor(high[0] / size); bx++) {
+                    for (var by = Math.floor(low[1] / size); by <= Math.floor(high[1] / size); by++) {
+                        requests.push(fetchBlock(zoom + '/' + target + '/' + year + '/' + bx + '_' + by + '.json')
+                            .then(function (bx, by) { return function (cells) { return [bx, by, cells]; }; }(bx, by)));
+                    }
+                }
+                Promise.all(requests).then(function (loaded) {
+                    if (request !== pending) { return; }
+                    layer.clearLayers();
+                    loaded.forEach(function (block) {
+                        block[2].forEach(function (c) {
+                            var x = block[0] * size + c[0], y = block[1] * size + c[1];
+                            var opacity = 0.15 + 0.7 * Math.sqrt(c[2] / max);
+                            L.rectangle([cellLatLng(x, y, n), cellLatLng(x + 1, y + 1, n)],
+                                        {renderer: renderer, stroke: false, fillColor: '#b30000', fillOpacity: opacity})
+                                .bindTooltip(c[2] + ' incidents').addTo(layer);
+                        });
+                    });
+                });
+            }
+
+            fetch(url + '/index.json').then(function (r) { return r.json(); }).then(function (data) {
+                index = data;
+                load();
+                map.on('moveend', load);
+            });
+        })();
+        {% endmacro %}
+    """)
+
+    def __init__(self, url, category, year, zooms):
+        super().__init__()
+        self._name = 'DensityLayer'
+        self.url = url
+        self.category = category
+        self.year = int(year)
+        self.zooms = sorted(int(z) for z in zooms)
+
+
+def make_density_map(pyramid, center, category, year, city, out_dir=DENSITY_DIR):
+    """ Writes the density files for pyramid and saves an html folium map
+        showing the density of category incidents in year
+        (view it through a web server, since the browser fetches the files)
+        Args:
+            pyramid: a dict built by build_density_pyramid
+            center: [latitude, longitude] for the center of the map
+            category: the category to draw
+            year: the year to draw
+            city: the name of the city
+            out_dir: folder the density files are written to
+    """
+    write_density_tiles(pyramid, out_dir)
+    mapa = folium.Map(center, zoom_start=12, tiles="CartoDB positron")
+    url = os.path.relpath(out_dir, '../html').replace(os.sep, '/')
+    DensityLayer(url, category, year, pyramid.keys()).add_to(mapa)
+    mapa.save(f'../html/{city}_{category}_{year}_density.html')
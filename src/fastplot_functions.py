@@ -0,0 +1,150 @@
+import numpy as np
+import matplotlib.pyplot as plt
+import seaborn as sns
+
+
+# Above these many points the plots switch from seaborn's exact swarm placement
+# and KDE to the binned versions below. Measured over five x levels (median
+# draw time, seaborn vs binned): the swarm took 252 vs 85 ms at 265 points,
+# 398 vs 80 ms at 500 and 2379 vs 68 ms at 1825, so the weekly and monthly
+# figures keep seaborn's exact layout and only denser swarms (e.g. daily) switch.
+# The KDEs were on par up to a few thousand points (145 vs 118 ms at 1825) and
+# the binned one only pulls clearly ahead beyond that (175 vs 118 ms at 10k,
+# 1155 vs 134 ms at 200k).
+FAST_SWARM_THRESHOLD = 500
+FAST_KDE_THRESHOLD = 10000
+
+
+def use_fast_path(fast, n_points, threshold=FAST_SWARM_THRESHOLD):
+    """ Returns whether to use the fast path: fast if given, otherwise whether
+        n_points is above threshold (FAST_SWARM_THRESHOLD or FAST_KDE_THRESHOLD)
+    """
+    if fast is None:
+        return n_points > threshold
+    return fast
+
+
+def binned_kde(values, grid_size=512, cut=3):
+    """ Returns (grid, density) of a gaussian kernel density estimate of values
+        using Scott's bandwidth (as seaborn does)
+        The values are linearly binned onto grid_size points and convolved with
+        the kernel by FFT, so the cost is O(n + grid_size log grid_size) rather
+        than O(n * grid_size).
+        Args:
+            values: array of observations
+            grid_size: number of points the density is evaluated on
+            cut: how many bandwidths past the extreme values the grid extends
+    """
+    values = np.asarray(values, dtype=float)
+    values = values[~np.isnan(values)]
+    n = len(values)
+    bandwidth = values.std(ddof=1) * n ** (-1 / 5) if n > 1 else 0
+    if bandwidth == 0:
+        bandwidth = 1.0
+    low, high = values.min() - cut * bandwidth, values.max() + cut * bandwidth
+    grid = np.linspace(low, high, grid_size)
+    step = grid[1] - grid[0]
+
+    position = (values - low) / step
+    left = np.clip(np.floor(position).astype(np.int64), 0, grid_size - 2)
+    weight = position - left
+    counts = (np.bincount(left, weights=1 - weight, minlength=grid_size)
+              + np.bincount(left + 1, weights=weight, minlength=grid_size))
+
+    # kernel sampled on the grid, zero padded to avoid circular wrap around
+    offsets = np.arange(-grid_size + 1, grid_size) * step
+    kernel = np.exp(-0.5 * (offsets / bandwidth) ** 2) / (bandwidth * np.sqrt(2 * np.pi))
+    size = 2 ** int(np.ceil(np.log2(len(counts) + len(kernel) - 1)))
+    smoothed = np.fft.irfft(np.fft.rfft(counts, size) * np.fft.rfft(kernel, size), size)
+    density = smoothed[grid_size - 1:2 * grid_size - 1] / n
+    return grid, np.clip(density, 0, None)
+
+
+def kdeplot(data, x, hue, palette, ax, fill=True):
+    """ Draws one binned KDE per hue level on ax, scaled like seaborn's default
+        (common_norm, so the areas of all levels sum to one)
+        Returns ax
+        Args:
+            data: pandas dataframe
+            x: column with the observations
+            hue: column splitting the observations into levels
+            palette: a matplotlib colormap for the (numeric) hue levels
+            ax: axis object
+            fill: whether to fill under the curves
+    """
+    levels = sorted(data[hue].unique())
+    norm = plt.Normalize(min(levels), max(levels))
+    total = len(data)
+    for level in levels:
+        values = data.loc[data[hue] == level, x]
+        if len(values) < 2:
+            continue
+        grid, density = binned_kde(values)
+        density = density * len(values) / total
+        color = palette(norm(level))
+        ax.plot(grid, density, color=color, label=str(level))
+        if fill:
+            ax.fill_between(grid, density, color=color, alpha=0.25, linewidth=0)
+    ax.set_xlabel(x)
+    ax.set_ylabel('Density')
+    ax.legend(title=hue)
+    return ax
+
+
+def beeswarm_offsets(values, point_height, point_width, max_width=0.8):
+    """ Returns horizontal offsets that spread values out like a beeswarm
+        Values are cut into rows one point tall; the points of a row are placed
+        side by side one point width apart, centered, and rows too wide for
+        max_width are squeezed to fit. Everything is vectorized.
+        Args:
+            values: array of the plotted (vertical) values
+            point_height: height of a point in data units
+            point_width: width of a point in data units
+            max_width: the widest a swarm may be in data units
+    """
+    values = np.asarray(values, dtype=float)
+    rows = np.floor(values / point_height).astype(np.int64)
+    order = np.argsort(rows, kind='stable')
+    sorted_rows = rows[order]
+    starts = np.r_[0, np.flatnonzero(np.diff(sorted_rows)) + 1]
+    row_sizes = np.diff(np.r_[starts, len(values)])
+    rank = np.arange(len(values)) - np.repeat(starts, row_sizes)
+    half_slots = (np.repeat(row_sizes, row_sizes) - 1) / 2
+    slot = rank - half_slots
+    half_width = half_slots * point_width
+    squeeze = np.where(half_width > max_width / 2, (max_width / 2) / np.maximum(half_width, 1e-12), 1)
+    offsets = np.empty(len(values))
+    offsets[order] = slot * point_width * squeeze
+    return offsets
+
+
+def swarmplot(data, x, y, ax, size=4, palette=None):
+    """ Scatter of y for each level of x with beeswarm placement, drawn at the
+        same positions (0, 1, ...) as a seaborn boxplot of the same data
+        Returns ax
+        Args:
+            data: pandas dataframe
+            x: column with the categories
+            y: column with the values
+            ax: axis object
+            size: marker diameter in points
+            palette: list of colors, one per level (None uses the default palette)
+    """
+    levels = sorted(data[x].unique())
+    colors = palette if palette is not None else sns.color_palette(n_colors=len(levels))
+    values = data[y].to_numpy(dtype=float)
+    if len(values) == 0:
+        return ax
+    span = (values.max() - values.min()) * 1.1 or 1.0
+    fig = ax.get_figure()
+    height_points = ax.bbox.height * 72 / fig.dpi
+    width_points = ax.bbox.width * 72 / fig.dpi
+    point_height = span / height_points * size
+    point_width = len(levels) / width_points * size
+    for i, level in enumerate(levels):
+        level_values = data.loc[data[x] == level, y].to_numpy(dtype=float)
+        offsets = beeswarm_offsets(level_values, point_height, point_width)
+        ax.scatter(i + offsets, level_values, s=size ** 2, color=colors[i % len(colors)], zorder=3, linewidths=0)
+    ax.set_xticks(range(len(levels)))
+    ax.set_xticklabels([str(level) for level in levels])
+    return ax
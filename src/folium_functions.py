@@ -1,6 +1,40 @@
+import numpy as np
+import pandas as pd
 import folium
-from folium.plugins import MarkerCluster
-from crime import capitalize_titles
+from folium.plugins import MarkerCluster, FastMarkerCluster
+from normalize_functions import display_titles
+import profile_functions
+from profile_functions import profiled
+
+
+# Client side marker builders for FastMarkerCluster: each row of the data
+# array becomes one marker in the browser, so no python object per incident.
+CIRCLE_CALLBACK = """
+function (row) {
+    return L.circle(new L.LatLng(row[0], row[1]), {radius: 10, count: 1});
+}
+"""
+
+WEIGHTED_CIRCLE_CALLBACK = """
+function (row) {
+    var marker = L.circle(new L.LatLng(row[0], row[1]), {radius: 10, count: row[2]});
+    marker.bindTooltip(row[2] + ' incidents');
+    return marker;
+}
+"""
+
+# Cluster icons show the number of incidents under them rather than the number
+# of markers, which differ once points are pre-clustered into grid cells.
+INCIDENT_COUNT_ICON = """
+function (cluster) {
+    var total = 0;
+    cluster.getAllChildMarkers().forEach(function (marker) { total += marker.options.count; });
+    var size = total < 100 ? 'small' : (total < 1000 ? 'medium' : 'large');
+    return L.divIcon({html: '<div><span>' + total + '</span></div>',
+                      className: 'marker-cluster marker-cluster-' + size,
+                      iconSize: new L.Point(40, 40)});
+}
+"""
 
 
 def crime_marking(x, marker_cluster):
@@ -14,7 +48,27 @@ def crime_marking(x, marker_cluster):
     folium.Circle(location=[x[0], x[1]]).add_to(marker_cluster)
 
 
-def make_layered_clustered_map(df, center, categories, offense_category_id, geo_lat, geo_lon, city):
+def grid_precluster(lat, lon, cell_size):
+    """ Snaps points to a square grid and returns a dataframe with one row per
+        occupied cell: the mean 'lat' and 'lon' of its points and their 'count'
+        Args:
+            lat: array of latitudes
+            lon: array of longitudes
+            cell_size: width of a grid cell in degrees
+    """
+    lat = np.asarray(lat, dtype=float)
+    lon = np.asarray(lon, dtype=float)
+    cells = np.stack([np.floor(lat / cell_size), np.floor(lon / cell_size)], axis=1).astype(np.int64)
+    _, inverse, counts = np.unique(cells, axis=0, return_inverse=True, return_counts=True)
+    inverse = inverse.reshape(-1)
+    return pd.DataFrame({'lat': np.bincount(inverse, weights=lat) / counts,
+                         'lon': np.bincount(inverse, weights=lon) / counts,
+                         'count': counts})
+
+
+@profiled()
+def make_layered_clustered_map(df, center, categories, offense_category_id, geo_lat, geo_lon, city,
+                               fast=False, cell_size=None, year=2020):
     """ Makes an html Folium map with layers for each category
         Args:
             df: pandas dataframe
@@ -24,15 +78,32 @@ def make_layered_clustered_map(df, center, categories, offense_category_id, geo_
             geo_lat: the name of the column with the latitude coordinate
             geo_long: the name of the column with the longitude coordinate
             city: the name of the city
+            fast: if True, pass each category's coordinates to the browser as one
+            array (FastMarkerCluster) instead of building a folium.Circle per incident
+            cell_size: if given (degrees, e.g. 0.001), incidents are first
+            aggregated into grid cells of this size and one weighted marker per
+            cell is sent, which bounds the html size (implies fast)
+            year: the year of incidents to map
     """
 
     mapa = folium.Map(center, zoom_start=12)
-    for category in categories:
-        fg = folium.FeatureGroup(name=capitalize_titles(category), show=False)
+    year_df = df[df.year == year]
+    for category, title in zip(categories, display_titles(categories)):
+        fg = folium.FeatureGroup(name=title, show=False)
         mapa.add_child(fg)
-        marker_cluster = folium.plugins.MarkerCluster().add_to(fg)
-        loc = df[(df[offense_category_id] == category) & (df.year == 2020)][[geo_lat, geo_lon]].dropna()
-        loc.apply(lambda x: crime_marking(x, marker_cluster), axis=1)
+        loc = year_df[year_df[offense_category_id] == category][[geo_lat, geo_lon]].dropna()
+        with profile_functions.stage('markers', rows=len(loc)):
+            if cell_size is not None:
+                cells = grid_precluster(loc[geo_lat], loc[geo_lon], cell_size).round({'lat': 5, 'lon': 5})
+                data = [[lat, lon, int(count)] for lat, lon, count in cells.itertuples(index=False)]
+                FastMarkerCluster(data, callback=WEIGHTED_CIRCLE_CALLBACK, icon_create_function=INCIDENT_COUNT_ICON).add_to(fg)
+            elif fast:
+                FastMarkerCluster(loc.round(5).values.tolist(), callback=CIRCLE_CALLBACK).add_to(fg)
+            else:
+                marker_cluster = folium.plugins.MarkerCluster().add_to(fg)
+                loc.apply(lambda x: crime_marking(x, marker_cluster), axis=1)
     folium.TileLayer('openstreetmap').add_to(mapa)
     folium.LayerControl().add_to(mapa)
-    mapa.save(f'../html/{city}clustermap.html')
+    path = f'../html/{city}clustermap.html'
+    with profile_functions.stage('folium_save', output=path):
+        mapa.save(path)
@@ -0,0 +1,271 @@
+import os
+import sys
+import json
+import time
+import hashlib
+import resource
+import numpy as np
+import pandas as pd
+
+
+CACHE_DIR = '../data/cache'
+
+CATEGORICAL_COLS = ['OFFENSE_TYPE_ID', 'OFFENSE_CATEGORY_ID', 'NEIGHBORHOOD_ID', 'DISTRICT_ID']
+
+DATE_PART_DTYPES = {'year': 'int16', 'month': 'int8', 'week': 'int8'}
+
+FAST_DATE_FORMAT = '%m/%d/%Y %I:%M:%S %p'
+
+PLOT_COLUMNS = ['INCIDENT_ID', 'OFFENSE_CATEGORY_ID', 'FIRST_OCCURRENCE_DATE', 'NEIGHBORHOOD_ID', 'GEO_LAT', 'GEO_LON']
+
+
+def cache_path(filename, dt_cols, format, date_col, cache_dir=CACHE_DIR, cache_format='parquet'):
+    """ Returns the path of the columnar cache file for a crime csv
+        The file name is keyed by the absolute source path, its modification
+        time and size and the parse arguments, so editing the csv or changing
+        how it is parsed never returns a stale cache.
+        Args:
+            filename: path of the source csv
+            dt_cols: list of the columns converted to datetimes
+            format: the datetime format string used for dt_cols
+            date_col: the column year, month and week are derived from
+            cache_dir: directory the cache files are stored in
+            cache_format: 'parquet' or 'feather'
+    """
+    stat = os.stat(filename)
+    key = json.dumps([os.path.abspath(filename), stat.st_mtime_ns, stat.st_size,
+                      list(dt_cols), format, date_col])
+    digest = hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+    name = os.path.splitext(os.path.basename(filename))[0]
+    return os.path.join(cache_dir, f'{name}_{digest}.{cache_format}')
+
+
+def compact_dtypes(df, categorical_cols=CATEGORICAL_COLS):
+    """ Returns df with low cardinality label columns stored as categoricals,
+        integer id columns downcast and year/month/week as small integers
+        (numeric label columns such as a numeric DISTRICT_ID are downcast
+        rather than made categorical)
+        Args:
+            df: pandas crime dataframe
+            categorical_cols: list of columns to store as categoricals
+    """
+    df = df.copy()
+    for col in categorical_cols:
+        if col in df.columns and df[col].dtype == object:
+            df[col] = df[col].astype('category')
+    for col in df.select_dtypes('integer').columns:
+        if col not in DATE_PART_DTYPES:
+            df[col] = pd.to_numeric(df[col], downcast='integer')
+    for col, dtype in DATE_PART_DTYPES.items():
+        if col in df.columns:
+            if df[col].isnull().any():
+                df[col] = df[col].astype(dtype.capitalize())
+            else:
+                df[col] = df[col].astype(dtype)
+    return df
+
+
+def write_cache(df, path):
+    """ Writes df to path as parquet or feather depending on the file extension
+        Args:
+            df: pandas dataframe
+            path: path of the cache file
+    """
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    df = df.reset_index(drop=True)
+    if path.endswith('.feather'):
+        df.to_feather(path)
+    else:
+        df.to_parquet(path, index=False)
+
+
+def read_cache(path, columns=None):
+    """ Returns the dataframe stored at path, reading only columns if given
+        Args:
+            path: path of the cache file
+            columns: list of columns to load (None loads every column)
+    """
+    if path.endswith('.feather'):
+        return pd.read_feather(path, columns=columns)
+    return pd.read_parquet(path, columns=columns)
+
+
+def add_date_parts(df, date_col):
+    """ Adds year, month and (iso) week columns derived from date_col to df
+        Args:
+            df: pandas dataframe
+            date_col: name of a datetime column in df
+    """
+    df['year'] = df[date_col].dt.year
+    df['month'] = df[date_col].dt.month
+    df['week'] = df[date_col].dt.isocalendar().week
+
+
+def _parse_fixed_width_dates(values):
+    """ Returns a datetime64[s] array for an array of strings that all look like
+        'MM/DD/YYYY HH:MM:SS AM', or None if any value does not fit that layout
+        The digits are read straight out of the bytes so no python level
+        parsing happens per row.
+    """
+    try:
+        raw = np.asarray(values, dtype='S22')
+    except UnicodeEncodeError:
+        return None
+    b = raw.view(np.uint8).reshape(-1, 22).astype(np.int64)
+    if not ((b[:, [2, 5]] == ord('/')).all() and (b[:, [13, 16]] == ord(':')).all()
+            and (b[:, [10, 19]] == ord(' ')).all() and (b[:, 21] == ord('M')).all()):
+        return None
+    digits = b[:, [0, 1, 3, 4, 6, 7, 8, 9, 11, 12, 14, 15, 17, 18]] - ord('0')
+    if ((digits < 0) | (digits > 9)).any():
+        return None
+    d = digits.T
+    month = d[0] * 10 + d[1]
+    day = d[2] * 10 + d[3]
+    year = d[4] * 1000 + d[5] * 100 + d[6] * 10 + d[7]
+    hour = d[8] * 10 + d[9]
+    minute = d[10] * 10 + d[11]
+    second = d[12] * 10 + d[13]
+    pm = b[:, 20] == ord('P')
+    if (((month < 1) | (month > 12) | (day < 1) | (day > 31) | (hour < 1) | (hour > 12)).any()
+            or not (pm | (b[:, 20] == ord('A'))).all()):
+        return None
+    hour = hour % 12 + 12 * pm
+    months = ((year - 1970) * 12 + month - 1).astype('datetime64[M]')
+    days = months.astype('datetime64[D]') + (day - 1)
+    if (days.astype('datetime64[M]') != months).any():
+        return None
+    return days.astype('datetime64[s]') + hour * 3600 + minute * 60 + second
+
+
+def parse_datetimes(series, format):
+    """ Returns series converted to datetimes
+        Strings in the '%m/%d/%Y %I:%M:%S %p' format used by the Denver and Seattle
+        exports are parsed with a vectorized fixed width path; anything else falls
+        back to pd.to_datetime on the unique values only.
+        Args:
+            series: pandas series of date strings
+            format: the datetime format string
+    """
+    notnull = series.notnull().to_numpy()
+    values = series.to_numpy()[notnull]
+    parsed = None
+    if format == FAST_DATE_FORMAT and len(values) and (series[notnull].str.len() == 22).all():
+        parsed = _parse_fixed_width_dates(values)
+    if parsed is None:
+        codes, uniques = pd.factorize(values)
+        parsed = pd.to_datetime(uniques, format=format).to_numpy()[codes]
+    result = np.full(len(series), np.datetime64('NaT'), dtype='datetime64[ns]')
+    result[notnull] = parsed
+    return pd.Series(result, index=series.index, name=series.name)
+
+
+def peak_rss_mb():
+    """ Returns the peak resident set size of this process in megabytes """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return peak / 2**20
+    return peak / 2**10
+
+
+def concat_frames(frames):
+    """ Concatenates dataframes, unioning the categories of columns that are
+        categorical in every frame so they stay categorical instead of falling
+        back to object
+        Each frame's codes are recoded to the shared categories before the
+        concatenation, so no full length object column is ever built.
+    """
+    frames = [frame.copy(deep=False) for frame in frames]
+    for col in frames[0].columns:
+        if all(isinstance(frame[col].dtype, pd.CategoricalDtype) for frame in frames):
+            categories = frames[0][col].cat.categories
+            for frame in frames[1:]:
+                categories = categories.append(frame[col].cat.categories.difference(categories, sort=False))
+            dtype = pd.CategoricalDtype(categories)
+            for frame in frames:
+                frame[col] = frame[col].astype(dtype)
+    return pd.concat(frames, ignore_index=True)
+
+
+def read_csv_chunked(filename, dt_cols, format, date_col, usecols=PLOT_COLUMNS, dtype=None,
+                     chunksize=200000, categorical_cols=CATEGORICAL_COLS):
+    """ Reads a crime csv in chunks of chunksize rows, keeping only usecols,
+        parsing dt_cols and adding compact year, month and week columns per chunk
+        so the full width csv is never held in memory at once
+        dt_cols and date_col are always read, and usecols the file does not have
+        are skipped, so the default projection also works for other layouts.
+        Returns (dataframe, stats) where stats has the rows read, seconds taken,
+        rows/sec and peak resident memory in MB
+        Args:
+            filename: path of the crime csv
+            dt_cols: list of columns to convert to datetimes
+            format: the datetime format string for dt_cols
+            date_col: the column year, month and week are derived from
+            usecols: list of columns to read besides dt_cols and date_col
+            (None reads every column)
+            dtype: dict of column name to dtype passed to pd.read_csv
+            chunksize: number of rows parsed at a time
+            categorical_cols: label columns to read as categoricals
+    """
+    start = time.perf_counter()
+    if usecols is not None:
+        wanted = set(usecols) | set(dt_cols) | {date_col}
+        usecols = wanted.__contains__
+    dtype = dict(dtype or {})
+    for col in categorical_cols:
+        if usecols is None or usecols(col):
+            dtype.setdefault(col, 'category')
+    chunks = []
+    for chunk in pd.read_csv(filename, usecols=usecols, dtype=dtype, chunksize=chunksize):
+        for col in dt_cols:
+            chunk[col] = parse_datetimes(chunk[col], format)
+        add_date_parts(chunk, date_col)
+        chunks.append(compact_dtypes(chunk, categorical_cols=[]))
+    df = concat_frames(chunks)
+    seconds = time.perf_counter() - start
+    stats = {'rows': len(df),
+             'seconds': seconds,
+             'rows_per_sec': len(df) / seconds if seconds else float('inf'),
+             'peak_rss_mb': peak_rss_mb()}
+    return df, stats
+
+
+def _hashable(series):
+    """ Returns series in a dtype that hashes the same however it was loaded:
+        numbers (including numeric categories) as float64, so 3146937 read as
+        int from an export without missing values matches the 3146937.0 of a
+        stored float column with NaNs, and anything else as objects
+    """
+    dtype = series.cat.categories.dtype if isinstance(series.dtype, pd.CategoricalDtype) else series.dtype
+    if pd.api.types.is_numeric_dtype(dtype) and not pd.api.types.is_bool_dtype(dtype):
+        return series.astype('float64')
+    return series.astype(object)
+
+
+def _incident_signatures(df, key, columns):
+    """ Returns a series of one order independent hash per key value, summing
+        the hashes of every row (offense) of that incident
+        Values are normalized first (see _hashable) so the same record hashes
+        the same whether it was loaded with compact or default dtypes.
+    """
+    values = pd.DataFrame({col: _hashable(df[col]) for col in columns})
+    hashes = pd.util.hash_pandas_object(values, index=False)
+    return hashes.groupby(df[key].to_numpy()).sum()
+
+
+def diff_export(df, export, key='INCIDENT_ID'):
+    """ Compares a newly downloaded export with the stored dataframe
+        Returns (removed, added) where added holds the export rows of incidents
+        that are new or whose rows changed, and removed holds the stored rows of
+        the changed incidents that added replaces. Only rows whose key appears
+        in the export are hashed.
+        Args:
+            df: the stored pandas crime dataframe
+            export: pandas dataframe of the new export, parsed like df
+            key: the incident identifier column
+    """
+    columns = [col for col in export.columns if col in df.columns and col not in DATE_PART_DTYPES]
+    stored = df[df[key].isin(export[key].unique())]
+    old = _incident_signatures(stored, key, columns)
+    new = _incident_signatures(export, key, columns)
+    changed = new.index[~new.index.isin(old.index) | (new != old.reindex(new.index)).to_numpy()]
+    return stored[stored[key].isin(changed)], export[export[key].isin(changed)]
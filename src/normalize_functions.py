@@ -0,0 +1,151 @@
+import functools
+import numpy as np
+import pandas as pd
+
+
+# Neighborhood renames as (old NEIGHBORHOOD_ID, new NEIGHBORHOOD_ID, date the
+# new name took effect). By default a rename relabels every year, as the README
+# does for Stapleton, so a neighborhood keeps one name across the whole series
+# (and matches the current shapefile); given incident dates, a rename is only
+# applied to incidents dated on or after it took effect.
+NEIGHBORHOOD_RENAMES = [('stapleton', 'central-park', '2020-08-01')]
+
+
+@functools.lru_cache(maxsize=None)
+def capitalize_titles(string):
+    return ' '.join([x.capitalize() for x in string.split('-')])
+
+
+def clean_shape_names(string):
+    return string.replace('- ', '')
+
+
+def clean_neighborhood_names(string):
+    name = ' '.join([x.capitalize() for x in string.split('-')])
+    if name == 'Dia':
+        return 'DIA'
+    return name
+
+
+@functools.lru_cache(maxsize=256)
+def _mapped_categories(function, categories):
+    """ Returns (new categories, array mapping each old category code to its
+        new code) for function applied to each of categories
+        Memoized, so a column with the same categories is only mapped once.
+    """
+    labels = [function(category) for category in categories]
+    codes, uniques = pd.factorize(pd.Series(labels, dtype=object))
+    return pd.Index(uniques), codes
+
+
+def map_categories(series, function):
+    """ Returns series as a categorical with function applied to each distinct
+        value rather than to every row
+        Values function maps to the same label are merged into one category and
+        a None result becomes missing.
+        Args:
+            series: pandas series (converted to a categorical once if it is not one)
+            function: function of one value returning its new label
+    """
+    if not isinstance(series.dtype, pd.CategoricalDtype):
+        series = series.astype('category')
+    categories, code_map = _mapped_categories(function, tuple(series.cat.categories))
+    old_codes = series.cat.codes.to_numpy()
+    codes = code_map[old_codes] if len(code_map) else old_codes.copy()
+    codes[old_codes == -1] = -1
+    return pd.Series(pd.Categorical.from_codes(codes, categories), index=series.index, name=series.name)
+
+
+@functools.lru_cache(maxsize=None)
+def _rename_function(as_of):
+    renames = {old: new for old, new, effective in NEIGHBORHOOD_RENAMES
+               if as_of is None or pd.Timestamp(effective) <= pd.Timestamp(as_of)}
+
+    def rename(name):
+        while name in renames:
+            name = renames[name]
+        return name
+    return rename
+
+
+def _map_by_date(series, dates, functions, as_of):
+    """ Returns series as a categorical with, for each row, functions(cutoff)
+        applied where cutoff is the latest rename effective date on or before
+        the row's date, so each rename only applies from its effective date
+        Rows are grouped by cutoff and each group mapped once per distinct
+        value (see map_categories). Rows without a date get every rename.
+    """
+    if not isinstance(series.dtype, pd.CategoricalDtype):
+        series = series.astype('category')
+    cutoffs = sorted({pd.Timestamp(effective) for _, _, effective in NEIGHBORHOOD_RENAMES
+                      if as_of is None or pd.Timestamp(effective) <= pd.Timestamp(as_of)})
+    if not cutoffs:
+        return map_categories(series, functions(as_of))
+    dates = pd.to_datetime(pd.Series(dates)).to_numpy(dtype='datetime64[ns]')
+    group = np.searchsorted(np.array(cutoffs, dtype='datetime64[ns]'), dates, side='right')
+    group[np.isnat(dates)] = len(cutoffs)
+    # before the first rename took effect, nothing is renamed
+    groups = [functions(cutoffs[0] - pd.Timedelta(1, 'ns'))] + [functions(cutoff) for cutoff in cutoffs]
+
+    old_codes = series.cat.codes.to_numpy()
+    mapped = [_mapped_categories(function, tuple(series.cat.categories)) for function in groups]
+    categories = pd.Index([]).append([labels for labels, _ in mapped]).unique()
+    codes = np.full(len(series), -1, dtype=np.int64)
+    for i, (labels, code_map) in enumerate(mapped):
+        rows = (group == i) & (old_codes != -1)
+        codes[rows] = categories.get_indexer(labels)[code_map[old_codes[rows]]]
+    return pd.Series(pd.Categorical.from_codes(codes, categories), index=series.index, name=series.name)
+
+
+def rename_neighborhoods(series, as_of=None, dates=None):
+    """ Returns the NEIGHBORHOOD_ID series as a categorical with the
+        NEIGHBORHOOD_RENAMES applied (e.g. stapleton -> central-park)
+        Args:
+            series: pandas series of neighborhood ids
+            as_of: only apply renames effective on or before this date
+            (None applies every rename)
+            dates: the incidents' dates, aligned with series; if given, each
+            rename is only applied to incidents dated on or after it took
+            effect (None applies it to every incident)
+    """
+    if dates is not None:
+        return _map_by_date(series, dates, _rename_function, as_of)
+    return map_categories(series, _rename_function(as_of))
+
+
+@functools.lru_cache(maxsize=None)
+def _display_name_function(as_of):
+    rename = _rename_function(as_of)
+
+    def display_name(name):
+        return clean_neighborhood_names(rename(name))
+    return display_name
+
+
+def neighborhood_display_name(name, as_of=None):
+    """ Returns the display name of one neighborhood id (see neighborhood_display_names) """
+    return _display_name_function(as_of)(name)
+
+
+def neighborhood_display_names(series, as_of=None, dates=None):
+    """ Returns the NEIGHBORHOOD_ID series renamed (see rename_neighborhoods) and
+        cleaned to the shapefile's NBHD_NAME form ('five-points' -> 'Five Points')
+        as a categorical
+        Args:
+            series: pandas series of neighborhood ids
+            as_of: only apply renames effective on or before this date
+            (None applies every rename)
+            dates: the incidents' dates (see rename_neighborhoods)
+    """
+    if dates is not None:
+        return _map_by_date(series, dates, _display_name_function, as_of)
+    return map_categories(series, _display_name_function(as_of))
+
+
+def display_titles(values):
+    """ Returns a categorical series of the display titles ('auto-theft' -> 'Auto Theft')
+        of values (a series, or a list of labels)
+    """
+    if not isinstance(values, pd.Series):
+        values = pd.Series(list(values), dtype=object)
+    return map_categories(values, capitalize_titles)
@@ -0,0 +1,228 @@
+import os
+import json
+import time
+import atexit
+import functools
+import threading
+import tracemalloc
+import pandas as pd
+import ingest_functions
+
+
+# CRIME_PROFILE=1 records every stage with wall time, rows, peak memory and
+# output bytes; CRIME_PROFILE=time skips the allocation tracing. Unset (or 0),
+# stage() and @profiled cost one flag check.
+PROFILE_ENV = 'CRIME_PROFILE'
+TRACE_ENV = 'CRIME_PROFILE_TRACE'
+TRACE_FILE = '../data/profile_trace.json'
+
+_settings = {'enabled': False, 'memory': False, 'pid': None, 'origin': 0.0}
+_records = []
+_local = threading.local()
+
+
+class _NullStage():
+    """ What stage() returns when profiling is off """
+
+    rows = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def __setattr__(self, name, value):
+        pass
+
+    def output(self, path):
+        pass
+
+
+_NULL_STAGE = _NullStage()
+
+
+class _Stage():
+
+    def __init__(self, name, rows, outputs):
+        self.name = name
+        self.rows = rows
+        self.outputs = list(outputs)
+        self.child_output_bytes = 0
+
+    def output(self, path):
+        """ Counts the size of the file at path (once the stage ends) as output """
+        self.outputs.append(path)
+
+    def __enter__(self):
+        stack = _stack()
+        self.parent = stack[-1] if stack else None
+        self.path = f'{self.parent.path}/{self.name}' if self.parent else self.name
+        if _settings['memory']:
+            current, peak = tracemalloc.get_traced_memory()
+            if self.parent:
+                self.parent.peak = max(self.parent.peak, peak)
+            tracemalloc.reset_peak()
+            self.start_memory = self.peak = current
+        stack.append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self.start
+        _stack().pop()
+        peak_mb = None
+        if _settings['memory']:
+            self.peak = max(self.peak, tracemalloc.get_traced_memory()[1])
+            peak_mb = (self.peak - self.start_memory) / 2 ** 20
+            if self.parent:
+                self.parent.peak = max(self.parent.peak, self.peak)
+            tracemalloc.reset_peak()
+        output_bytes = self.child_output_bytes + sum(os.path.getsize(path) for path in self.outputs
+                                                     if os.path.exists(path))
+        if self.parent:
+            self.parent.child_output_bytes += output_bytes
+        _records.append({'stage': self.name, 'path': self.path, 'start': self.start - _settings['origin'],
+                         'seconds': seconds, 'rows': self.rows, 'peak_mb': peak_mb,
+                         'rss_mb': ingest_functions.peak_rss_mb(), 'output_bytes': output_bytes,
+                         'thread': threading.get_ident()})
+        return False
+
+
+def _stack():
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+
+def enable(memory=True, trace_file=None, report=True):
+    """ Turns stage recording on (as setting CRIME_PROFILE does)
+        Args:
+            memory: whether to trace allocations for each stage's peak memory
+            trace_file: where the JSON trace is written (None uses
+            CRIME_PROFILE_TRACE or TRACE_FILE)
+            report: whether to write the trace and print the summary table
+            when the process exits
+    """
+    if not _settings['enabled']:
+        _settings['origin'] = time.perf_counter()
+    if report and not _settings.get('report'):
+        atexit.register(_report_at_exit)
+    _settings.update(enabled=True, memory=memory, pid=os.getpid(), report=report or _settings.get('report', False),
+                     trace_file=trace_file or os.environ.get(TRACE_ENV, TRACE_FILE))
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def disable():
+    """ Turns stage recording off (recorded stages are kept) """
+    _settings['enabled'] = False
+    if _settings['memory'] and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    _settings['memory'] = False
+
+
+def enabled():
+    return _settings['enabled']
+
+
+def reset():
+    """ Forgets the recorded stages """
+    _records.clear()
+
+
+def stage(name, rows=None, output=None):
+    """ Context manager recording one stage: wall time, rows, peak memory
+        (allocations above the level at entry) and output bytes (including
+        those of nested stages)
+        Nested stages are recorded with their parent's path ('load/to_datetime').
+        Args:
+            name: name of the stage
+            rows: number of rows processed (can also be set on the stage later)
+            output: path of a file the stage writes, whose size is recorded
+    """
+    if not _settings['enabled']:
+        return _NULL_STAGE
+    return _Stage(name, rows, [output] if output else [])
+
+
+def frame_rows(args):
+    """ Returns the length of the first dataframe among args (or of the df of
+        the first object holding one, like a CrimeDataFrame), or None
+    """
+    for arg in args:
+        if isinstance(arg, pd.DataFrame):
+            return len(arg)
+        if isinstance(getattr(arg, 'df', None), pd.DataFrame):
+            return len(arg.df)
+    return None
+
+
+def profiled(name=None):
+    """ Decorator recording every call of the function as a stage, named name
+        (default the function's qualified name), with rows from frame_rows
+        of its arguments (or, failing that, its result) once it returns
+    """
+    def decorator(function):
+        stage_name = name or function.__qualname__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _settings['enabled']:
+                return function(*args, **kwargs)
+            with _Stage(stage_name, None, []) as record:
+                result = function(*args, **kwargs)
+                record.rows = frame_rows(args + (result,))
+            return result
+        return wrapper
+    return decorator
+
+
+def records():
+    """ Returns the recorded stages as a dataframe, in the order they finished """
+    return pd.DataFrame(_records, columns=['stage', 'path', 'start', 'seconds', 'rows', 'peak_mb', 'rss_mb',
+                                           'output_bytes', 'thread'])
+
+
+def summary():
+    """ Returns a table of the recorded stages grouped by path, slowest first:
+        calls, total and mean seconds, rows, max peak_mb, output bytes and the
+        share of the top level stages' total time
+    """
+    df = records()
+    table = df.groupby('path', sort=False).agg(calls=('seconds', 'size'), seconds=('seconds', 'sum'),
+                                               mean_seconds=('seconds', 'mean'), rows=('rows', lambda rows: rows.sum(min_count=1)),
+                                               peak_mb=('peak_mb', 'max'), output_bytes=('output_bytes', 'sum'))
+    top_level = df.loc[~df['path'].str.contains('/'), 'seconds'].sum()
+    table['share'] = table['seconds'] / top_level if top_level else float('nan')
+    return table.sort_values('seconds', ascending=False).reset_index()
+
+
+def write_trace(path=TRACE_FILE):
+    """ Writes the recorded stages as JSON in the Chrome trace event format
+        (open in chrome://tracing or https://ui.perfetto.dev), with rows, peak
+        memory and output bytes as each event's args
+    """
+    events = [{'name': record['stage'], 'cat': record['path'], 'ph': 'X', 'pid': _settings['pid'],
+               'tid': record['thread'], 'ts': record['start'] * 1e6, 'dur': record['seconds'] * 1e6,
+               'args': {key: record[key] for key in ['path', 'rows', 'peak_mb', 'rss_mb', 'output_bytes']}}
+              for record in _records]
+    folder = os.path.dirname(path)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+
+def _report_at_exit():
+    # forked workers inherit the settings but only the process that enabled
+    # profiling reports
+    if os.getpid() != _settings['pid'] or not _records:
+        return
+    write_trace(_settings['trace_file'])
+    print(summary().to_string(index=False, float_format='{:.3f}'.format))
+    print(f"Profile trace written to {_settings['trace_file']}")
+
+
+if os.environ.get(PROFILE_ENV, '') not in ('', '0'):
+    enable(memory=os.environ[PROFILE_ENV] != 'time')
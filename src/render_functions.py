@@ -0,0 +1,108 @@
+import sys
+import time
+import multiprocessing
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import matplotlib
+import pandas as pd
+
+
+# One figure to render: getattr(datasets[dataset], method)(*args, **kwargs)
+# cube names the (offense_category_id, neighborhood_id) count cube the figure
+# reads, so it can be built once before the workers start.
+FigureJob = namedtuple('FigureJob', ['dataset', 'method', 'args', 'kwargs', 'cube'],
+                       defaults=[(), {}, (None, None)])
+
+_DATASETS = {}
+
+
+def denver_figure_jobs(categories, dataset='Denver'):
+    """ Returns the figure jobs for the full Denver image set
+        Args:
+            categories: list of offense categories to make a double_plot for
+            dataset: the name the Denver CrimeDataFrame is passed under
+    """
+    cube = ('OFFENSE_CATEGORY_ID', 'NEIGHBORHOOD_ID')
+    jobs = [FigureJob(dataset, 'lineplot_all_cats_over_time', ('OFFENSE_CATEGORY_ID', 'FIRST_OCCURRENCE_DATE', 'INCIDENT_ID', 'Denver'), cube=cube),
+            FigureJob(dataset, 'barplot_city_crime_by_category', ('OFFENSE_CATEGORY_ID', 'INCIDENT_ID', 'Denver', ["#1D3557", "#457B9D", "#A8DADC", "#F3C6C6", "#E63946"]), cube=cube),
+            FigureJob(dataset, 'boxplots_by_cat', ('OFFENSE_CATEGORY_ID', 'Denver'), cube=cube),
+            FigureJob(dataset, 'kdeplots_by_cat', ('OFFENSE_CATEGORY_ID', 'Denver'), cube=cube),
+            FigureJob(dataset, 'top_crime_neighborhoods', (15, 'NEIGHBORHOOD_ID', 'Denver'), cube=cube)]
+    for category in categories:
+        jobs.append(FigureJob(dataset, 'double_plot', (category, 'OFFENSE_CATEGORY_ID', 'FIRST_OCCURRENCE_DATE', 'INCIDENT_ID', 'Denver'), cube=cube))
+    return jobs
+
+
+def seattle_figure_jobs(dataset='Seattle'):
+    """ Returns the figure jobs for the Seattle image set
+        Args:
+            dataset: the name the Seattle CrimeDataFrame is passed under
+    """
+    return [FigureJob(dataset, 'top_crime_neighborhoods', (10, 'MCPP', 'Seattle'), cube=(None, 'MCPP'))]
+
+
+def _set_datasets(datasets):
+    global _DATASETS
+    _DATASETS = datasets
+
+
+def _init_worker(datasets):
+    matplotlib.use('Agg')
+    _set_datasets(datasets)
+
+
+def _render(job):
+    """ Renders one figure job, closing only the figures it opened, and
+        returns (job, seconds)
+    """
+    import matplotlib.pyplot as plt
+    start = time.perf_counter()
+    before = set(plt.get_fignums())
+    getattr(_DATASETS[job.dataset], job.method)(*job.args, **job.kwargs)
+    for number in set(plt.get_fignums()) - before:
+        plt.close(number)
+    return job, time.perf_counter() - start
+
+
+def render_figures(datasets, jobs, processes=None):
+    """ Renders and saves figure jobs across a process pool with the Agg backend
+        (rendering serially keeps the caller's backend)
+        The count cubes the jobs read are built once up front, so workers only
+        slice them; on Linux the workers are forked and share them, elsewhere
+        the platform's default start method pickles them to each worker.
+        Prints each figure's render time as it finishes and returns a dataframe
+        of the timings (slowest first)
+        Args:
+            datasets: dict of name -> CrimeDataFrame, the names used in the jobs
+            jobs: list of FigureJob
+            processes: number of worker processes (None uses every core, 1 renders serially)
+    """
+    start = time.perf_counter()
+    for dataset, cube in {(job.dataset, job.cube) for job in jobs}:
+        datasets[dataset].count_cube(*cube)
+    print(f'Computed figure data in {time.perf_counter() - start:.1f}s')
+
+    results = []
+
+    def record(i, job, seconds):
+        name = job.args[0] if job.method == 'double_plot' else ''
+        results.append({'dataset': job.dataset, 'figure': f'{job.method} {name}'.strip(), 'seconds': seconds})
+        print(f'[{i}/{len(jobs)}] {job.dataset} {results[-1]["figure"]} ({seconds:.1f}s)')
+
+    if processes == 1:
+        _set_datasets(datasets)
+        for i, job in enumerate(jobs, 1):
+            record(i, *_render(job))
+    else:
+        # fork is only safe on Linux; macOS defaults to spawn because forking
+        # after system frameworks are loaded can crash
+        context = multiprocessing.get_context('fork' if sys.platform.startswith('linux') else None)
+        with ProcessPoolExecutor(processes, mp_context=context, initializer=_init_worker, initargs=(datasets,)) as pool:
+            futures = [pool.submit(_render, job) for job in jobs]
+            for i, future in enumerate(as_completed(futures), 1):
+                record(i, *future.result())
+
+    results = pd.DataFrame(results, columns=['dataset', 'figure', 'seconds']).sort_values('seconds', ascending=False)
+    print(f'Rendered {len(results)} figures in {time.perf_counter() - start:.1f}s '
+          f'({results.seconds.sum():.1f}s of rendering)')
+    return results
@@ -0,0 +1,90 @@
+import numpy as np
+import pandas as pd
+import ingest_functions
+
+
+# Canonical columns every city is loaded into. They use the Denver names, so
+# the CrimeDataFrame methods called with the Denver column names work for any
+# registered city.
+CANONICAL_DTYPES = {'INCIDENT_ID': 'int64',
+                    'OFFENSE_CATEGORY_ID': 'category',
+                    'FIRST_OCCURRENCE_DATE': 'datetime64[ns]',
+                    'NEIGHBORHOOD_ID': 'category',
+                    'GEO_LAT': 'float64',
+                    'GEO_LON': 'float64'}
+
+# Per city: the default csv, its datetime format, the source column for each
+# canonical column and whether (0, 0) coordinates mean "unknown"
+SCHEMAS = {
+    'Denver': {'filename': '../data/denver_crime.csv',
+               'format': '%m/%d/%Y %I:%M:%S %p',
+               'columns': {'INCIDENT_ID': 'INCIDENT_ID',
+                           'OFFENSE_CATEGORY_ID': 'OFFENSE_CATEGORY_ID',
+                           'FIRST_OCCURRENCE_DATE': 'FIRST_OCCURRENCE_DATE',
+                           'NEIGHBORHOOD_ID': 'NEIGHBORHOOD_ID',
+                           'GEO_LAT': 'GEO_LAT',
+                           'GEO_LON': 'GEO_LON'},
+               'zero_coordinates_missing': False},
+    'Seattle': {'filename': '../data/Seattle_crime.csv',
+                'format': '%m/%d/%Y %I:%M:%S %p',
+                'columns': {'INCIDENT_ID': 'Offense ID',
+                            'OFFENSE_CATEGORY_ID': 'Offense Parent Group',
+                            'FIRST_OCCURRENCE_DATE': 'Offense Start DateTime',
+                            'NEIGHBORHOOD_ID': 'MCPP',
+                            'GEO_LAT': 'Latitude',
+                            'GEO_LON': 'Longitude'},
+                'zero_coordinates_missing': True},
+}
+
+
+def register_city(city, filename, format, columns, zero_coordinates_missing=False):
+    """ Adds (or replaces) a city in SCHEMAS
+        Args:
+            city: the name of the city
+            filename: path of the city's crime csv
+            format: the datetime format string of its date column
+            columns: dict of canonical column name -> source column name
+            (every key of CANONICAL_DTYPES must be mapped)
+            zero_coordinates_missing: whether 0 latitude/longitude means unknown
+    """
+    missing = set(CANONICAL_DTYPES) - set(columns)
+    if missing:
+        raise ValueError(f'{city} schema does not map {sorted(missing)}')
+    SCHEMAS[city] = {'filename': filename, 'format': format, 'columns': dict(columns),
+                     'zero_coordinates_missing': zero_coordinates_missing}
+
+
+def load_city(city, filename=None, chunksize=200000):
+    """ Returns the city's crime data in the canonical schema: only the mapped
+        columns are read (in chunks, with explicit dtypes), renamed to the
+        canonical names, with year, month and week added and a categorical
+        'city' column
+        Args:
+            city: a city registered in SCHEMAS
+            filename: path of the csv (None uses the registered one)
+            chunksize: number of rows parsed at a time
+    """
+    schema = SCHEMAS[city]
+    columns = schema['columns']
+    date_col = columns['FIRST_OCCURRENCE_DATE']
+    dtype = {columns[col]: dtype for col, dtype in CANONICAL_DTYPES.items() if col != 'FIRST_OCCURRENCE_DATE'}
+    df, _ = ingest_functions.read_csv_chunked(filename or schema['filename'], [date_col], schema['format'], date_col,
+                                              usecols=list(columns.values()), dtype=dtype, chunksize=chunksize,
+                                              categorical_cols=[])
+    df = df.rename(columns={source: canonical for canonical, source in columns.items()})
+    if schema['zero_coordinates_missing']:
+        zero = (df['GEO_LAT'] == 0) | (df['GEO_LON'] == 0)
+        df.loc[zero, ['GEO_LAT', 'GEO_LON']] = np.nan
+    df['city'] = pd.Categorical([city] * len(df))
+    return df[list(CANONICAL_DTYPES) + ['year', 'month', 'week', 'city']]
+
+
+def load_cities(cities, filenames=None):
+    """ Returns the crime data of several cities side by side in one canonical,
+        categorical encoded dataframe
+        Args:
+            cities: list of cities registered in SCHEMAS
+            filenames: optional dict of city -> csv path overriding the registered ones
+    """
+    filenames = filenames or {}
+    return ingest_functions.concat_frames([load_city(city, filenames.get(city)) for city in cities])
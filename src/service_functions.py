@@ -0,0 +1,406 @@
+import json
+import time
+import random
+import argparse
+import functools
+import threading
+import http.client
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qsl, urlencode
+import numpy as np
+import pandas as pd
+from branca.colormap import StepColormap
+from branca.element import MacroElement
+from branca.utilities import color_brewer
+from jinja2 import Template
+import folium
+import aggregate_functions
+import choropleth_functions
+import ingest_functions
+import normalize_functions
+from crime import CrimeDataFrame
+
+
+class ChoroplethQueryControl(MacroElement):
+    """ Category/year selectors for a map made by choropleth_plot: on change
+        the counts and colours are fetched from the query service's /choropleth
+        endpoint and applied to the existing layers, so one page shows every map
+        Args:
+            choropleth: the folium GeoJson layer filled by count
+            hover: the folium GeoJson layer carrying the tooltips
+            categories: list of categories to offer
+            years: list of years to offer
+            category: the category shown initially
+            year: the year shown initially
+    """
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+        (function () {
+            var map = {{ this._parent.get_name() }};
+            var layers = [{{ this.choropleth.get_name() }}, {{ this.hover.get_name() }}];
+            var categories = {{ this.categories|tojson }};
+            var years = {{ this.years|tojson }};
+            document.querySelectorAll('.legend.leaflet-control').forEach(function (e) { e.style.display = 'none'; });
+
+            var control = L.control({position: 'topright'});
+            control.onAdd = function () {
+                var div = L.DomUtil.create('div', 'leaflet-bar');
+                div.style.background = 'white';
+                div.style.padding = '6px';
+                div.innerHTML = '<select id="query-category"></select> <select id="query-year"></select>' +
+                                '<div id="query-legend" style="margin-top:4px;font-size:11px"></div>';
+                L.DomEvent.disableClickPropagation(div);
+                return div;
+            };
+            control.addTo(map);
+
+            function fill(id, values, selected) {
+                var select = document.getElementById(id);
+                values.forEach(function (v) {
+                    var option = document.createElement('option');
+                    option.value = v;
+                    option.text = v;
+                    option.selected = v === selected;
+                    select.appendChild(option);
+                });
+                select.addEventListener('change', update);
+            }
+
+            function tooltip(alias) {
+                return function (layer) {
+                    var table = document.createElement('table');
+                    [['Neighborhood: ', 'Neighborhood'], [alias, 'Count']].forEach(function (row) {
+                        var tr = table.insertRow();
+                        var th = document.createElement('th');
+                        th.textContent = row[0];
+                        tr.appendChild(th);
+                        tr.insertCell().textContent = layer.feature.properties[row[1]];
+                    });
+                    return table;
+                };
+            }
+
+            function update() {
+                var category = document.getElementById('query-category').value;
+                var year = document.getElementById('query-year').value;
+                fetch('/choropleth?' + new URLSearchParams({category: category, year: year}))
+                    .then(function (r) { return r.json(); })
+                    .then(function (data) {
+                        layers.forEach(function (layer) {
+                            layer.eachLayer(function (l) {
+                                var name = l.feature.properties.Neighborhood;
+                                l.feature.properties.Count = data.counts[name] || 0;
+                                if (layer === layers[0]) {
+                                    l.setStyle({fillColor: data.colors[name] || data.colors[''],
+                                                fillOpacity: 0.5});
+                                }
+                            });
+                        });
+                        layers[1].unbindTooltip();
+                        layers[1].bindTooltip(tooltip('Count of ' + category + ' incidences: '),
+                                              {sticky: true, className: 'foliumtooltip'});
+                        document.getElementById('query-legend').innerHTML = data.scale.slice(0, -1).map(function (low, i) {
+                            return '<span style="background:' + data.scale_colors[i] + '">&nbsp;&nbsp;&nbsp;</span> ' +
+                                   low + ' - ' + data.scale[i + 1];
+                        }).join('<br>');
+                    });
+            }
+
+            fill('query-category', categories, {{ this.category|tojson }});
+            fill('query-year', years, {{ this.year|tojson }});
+            update();
+        })();
+        {% endmacro %}
+    """)
+
+    def __init__(self, choropleth, hover, categories, years, category, year):
+        super().__init__()
+        self._name = 'ChoroplethQueryControl'
+        self.choropleth = choropleth
+        self.hover = hover
+        self.categories = [str(c) for c in categories]
+        self.years = [int(y) for y in years]
+        self.category = str(category)
+        self.year = int(year)
+
+
+class CrimeQueryService():
+    """ Answers incident count queries from indexes built once at startup
+        Counts by category and neighborhood over any date range come from an
+        aggregate_functions.DailyCountIndex (two cumulative slices per query),
+        and whole responses are kept in an LRU cache keyed by the normalized
+        query, so repeated queries are a dictionary lookup.
+    """
+
+    def __init__(self, df, shape_df, date_col='FIRST_OCCURRENCE_DATE', offense_category_id='OFFENSE_CATEGORY_ID',
+                 neighborhood_id='NEIGHBORHOOD_ID', cache_size=4096):
+        """ Args:
+                df: pandas crime dataframe
+                shape_df: pandas dataframe of cleaned .shp (see prepare_shapefile_dataframe)
+                date_col: datetime column incidents are dated by
+                offense_category_id: name of the column that categorizes the offense
+                neighborhood_id: name of the column identifying the neighborhood
+                cache_size: number of responses kept in the LRU cache
+        """
+        start = time.perf_counter()
+        neighborhoods = normalize_functions.neighborhood_display_names(df[neighborhood_id])
+        slim = pd.DataFrame({date_col: df[date_col], 'category': df[offense_category_id],
+                             'neighborhood': neighborhoods})
+        self.index = aggregate_functions.DailyCountIndex(slim, date_col, 'category', 'neighborhood')
+        self.shape_df = shape_df
+        self.categories = sorted(str(c) for c in self.index.categories)
+        dates = pd.DatetimeIndex(self.index.days)
+        self.years = sorted(set(dates.year)) if len(dates) else []
+        self._neighborhood_names = set(self.index.neighborhoods)
+        self.respond = functools.lru_cache(maxsize=cache_size)(self._respond)
+        self._scales = {}
+        self.page = self._build_page()
+        print(f'Indexed {len(df):,} incidents in {time.perf_counter() - start:.1f}s')
+
+    def _neighborhood(self, name):
+        """ Returns the display name for a neighborhood given either way
+            ('five-points' or 'Five Points')
+        """
+        return name if name in self._neighborhood_names else normalize_functions.neighborhood_display_name(name)
+
+    def counts(self, by=(), categories=None, neighborhoods=None, start=None, end=None):
+        """ Returns a list of {dimension: label, ..., 'count': n} records
+            Args:
+                by: dimensions to group by, from 'category', 'neighborhood'
+                categories: list of categories to count (None counts all)
+                neighborhoods: list of neighborhoods (ids or display names, None counts all)
+                start: first date counted, e.g. '2020-01-01' (None is open ended)
+                end: last date counted (None is open ended)
+        """
+        unknown = set(by) - {'category', 'neighborhood'}
+        if unknown:
+            raise ValueError(f"by must be from 'category', 'neighborhood', not {sorted(unknown)}")
+        self._check_categories(categories)
+        if neighborhoods is not None:
+            neighborhoods = [self._neighborhood(n) for n in neighborhoods]
+            unknown = [n for n in neighborhoods if n not in self._neighborhood_names]
+            if unknown:
+                raise KeyError(f'unknown neighborhood {unknown[0]!r}')
+        result = self.index.counts(list(by), categories, neighborhoods, start, end)
+        return [{key: (int(value) if key == 'count' else str(value)) for key, value in row.items()}
+                for row in result.to_dict('records')]
+
+    def _check_categories(self, categories):
+        unknown = [c for c in categories or () if c not in self.categories]
+        if unknown:
+            raise KeyError(f'unknown category {unknown[0]!r}')
+
+    def scale(self, category):
+        """ Returns the threshold scale of category shared by all its years (as
+            in choropleth_all_categories_and_years)
+        """
+        if category not in self._scales:
+            counts = [count for year in self.years
+                      for count in self._neighborhood_counts(category, f'{year}-01-01', f'{year}-12-31').values()]
+            self._scales[category] = choropleth_functions.quantile_scale(pd.Series(counts or [0]))
+        return self._scales[category]
+
+    def _neighborhood_counts(self, category, start, end):
+        names = set(self.shape_df['NBHD_NAME'])
+        rows = self.index.counts(['neighborhood'], [category], None, start, end)
+        return {str(n): int(c) for n, c in zip(rows['neighborhood'], rows['count']) if n in names}
+
+    def choropleth(self, category, year=None, start=None, end=None):
+        """ Returns the counts per shapefile neighborhood for category over year
+            (or start to end), the fill colour of each and the category's scale
+        """
+        self._check_categories([category])
+        if year is not None:
+            start, end = f'{int(year)}-01-01', f'{int(year)}-12-31'
+        counts = self._neighborhood_counts(category, start, end)
+        scale = self.scale(category)
+        colormap = StepColormap(color_brewer('OrRd', n=len(scale) - 1), index=scale, vmin=scale[0], vmax=scale[-1])
+        colors = {name: colormap.rgb_hex_str(count) for name, count in counts.items()}
+        colors[''] = colormap.rgb_hex_str(0)
+        return {'category': category, 'start': start, 'end': end, 'counts': counts, 'colors': colors,
+                'scale': scale, 'scale_colors': [colormap.rgb_hex_str(value) for value in scale[:-1]]}
+
+    def _build_page(self):
+        """ Returns the html of the interactive map: choropleth_plot of the first
+            category's last year plus a ChoroplethQueryControl
+        """
+        if not self.categories:
+            return '<html><body>No incidents indexed</body></html>'
+        category, year = self.categories[0], self.years[-1]
+        initial = self.choropleth(category, year)
+        count_df = pd.DataFrame({'Neighborhood': list(initial['counts']), 'Count': list(initial['counts'].values())})
+        data = choropleth_functions.merge_counts_with_shapes(self.shape_df, count_df)
+        mapa = choropleth_functions.choropleth_plot(data, initial['scale'], category, [year])
+        choropleth = next(child for child in mapa._children.values() if isinstance(child, folium.Choropleth)).geojson
+        hover = next(child for child in mapa._children.values() if isinstance(child, folium.GeoJson))
+        mapa.add_child(ChoroplethQueryControl(choropleth, hover, self.categories, self.years, category, year))
+        return mapa.get_root().render()
+
+    def _respond(self, path, query):
+        """ Returns (status, content type, body) for a request; memoized on
+            (path, sorted query pairs) as self.respond
+        """
+        params = dict(query)
+        lists = {key: [v for v in params[key].split(',') if v] if key in params else None
+                 for key in ['by', 'category', 'neighborhood']}
+        try:
+            if path == '/':
+                return 200, 'text/html; charset=utf-8', self.page.encode()
+            if path == '/meta':
+                body = {'categories': self.categories, 'years': [int(y) for y in self.years],
+                        'neighborhoods': [str(n) for n in self.index.neighborhoods],
+                        'first_day': str(self.index.days[0]) if len(self.index.days) else None,
+                        'last_day': str(self.index.days[-1]) if len(self.index.days) else None}
+            elif path == '/counts':
+                body = self.counts(lists['by'] or (), lists['category'], lists['neighborhood'],
+                                   params.get('start'), params.get('end'))
+            elif path == '/choropleth':
+                if 'category' not in params:
+                    raise ValueError('category is required')
+                body = self.choropleth(params['category'], params.get('year'), params.get('start'), params.get('end'))
+            else:
+                return 404, 'application/json', json.dumps({'error': f'no such endpoint {path}'}).encode()
+        except KeyError as error:
+            return 404, 'application/json', json.dumps({'error': str(error.args[0])}).encode()
+        except ValueError as error:
+            return 400, 'application/json', json.dumps({'error': str(error)}).encode()
+        return 200, 'application/json', json.dumps(body, separators=(',', ':')).encode()
+
+    def handler(self):
+        """ Returns a request handler class serving this service """
+        service = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # keep-alive responses are small; without this, Nagle's algorithm
+            # holds each body back until the client's delayed ACK (~40ms)
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                url = urlsplit(self.path)
+                status, content_type, body = service.respond(url.path, tuple(sorted(parse_qsl(url.query))))
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def serve(self, host='127.0.0.1', port=8000):
+        """ Serves the map page at / and the /counts, /choropleth and /meta
+            JSON endpoints until interrupted
+        """
+        server = ThreadingHTTPServer((host, port), self.handler())
+        print(f'Serving on http://{host}:{port}/')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+
+
+def load_service(filename='../data/denver_crime.csv', cache_dir=ingest_functions.CACHE_DIR):
+    """ Returns a CrimeQueryService over the Denver data, loading it from the
+        columnar cache (see CrimeDataFrame) and the shapefile
+        Args:
+            filename: path of the crime csv
+            cache_dir: folder of the columnar cache
+    """
+    crime = CrimeDataFrame(filename, ['FIRST_OCCURRENCE_DATE'], '%m/%d/%Y %I:%M:%S %p', 'FIRST_OCCURRENCE_DATE',
+                           cache_dir=cache_dir, columns=['FIRST_OCCURRENCE_DATE', 'OFFENSE_CATEGORY_ID', 'NEIGHBORHOOD_ID'])
+    shape_df = choropleth_functions.prepare_shapefile_dataframe()
+    shape_df['geometry'] = shape_df.geometry.simplify(0.0001, preserve_topology=True)
+    return CrimeQueryService(crime.df, shape_df)
+
+
+def _random_query(meta, rng):
+    """ Returns a random /counts or /choropleth url over the service's labels """
+    first, last = np.datetime64(meta['first_day']), np.datetime64(meta['last_day'])
+    span = int((last - first).astype(np.int64)) + 1
+    if rng.random() < 0.2:
+        return '/choropleth?' + urlencode({'category': rng.choice(meta['categories']),
+                                           'year': rng.choice(meta['years'])})
+    start = first + rng.randrange(span)
+    params = {'start': str(start), 'end': str(start + rng.randrange(1, 366)),
+              'by': rng.choice(['neighborhood', 'category', 'category,neighborhood'])}
+    if rng.random() < 0.7:
+        params['category'] = rng.choice(meta['categories'])
+    if rng.random() < 0.3:
+        params['neighborhood'] = rng.choice(meta['neighborhoods'])
+    return '/counts?' + urlencode(params)
+
+
+def load_test(host='127.0.0.1', port=8000, requests=5000, concurrency=8, distinct=500, seed=0):
+    """ Sends requests drawn from distinct random queries from concurrency
+        keep-alive connections and returns the latency percentiles in ms
+        (p50, p90, p99, max) and the throughput
+        Args:
+            host, port: where the service is listening
+            requests: total number of requests
+            concurrency: number of client threads
+            distinct: number of distinct queries the requests are drawn from
+            (fewer distinct queries means more LRU cache hits)
+            seed: random seed
+    """
+    connection = http.client.HTTPConnection(host, port)
+    connection.request('GET', '/meta')
+    meta = json.loads(connection.getresponse().read())
+    connection.close()
+    rng = random.Random(seed)
+    queries = [_random_query(meta, rng) for _ in range(distinct)]
+    urls = [rng.choice(queries) for _ in range(requests)]
+    latencies = [[] for _ in range(concurrency)]
+    errors = []
+
+    def worker(i):
+        connection = http.client.HTTPConnection(host, port)
+        for url in urls[i::concurrency]:
+            start = time.perf_counter()
+            connection.request('GET', url)
+            response = connection.getresponse()
+            response.read()
+            latencies[i].append(time.perf_counter() - start)
+            if response.status != 200:
+                errors.append(url)
+        connection.close()
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.perf_counter() - start
+    ms = np.concatenate([np.asarray(l) for l in latencies]) * 1000
+    result = {'requests': len(ms), 'errors': len(errors), 'seconds': seconds, 'requests_per_sec': len(ms) / seconds,
+              'p50_ms': np.percentile(ms, 50), 'p90_ms': np.percentile(ms, 90), 'p99_ms': np.percentile(ms, 99),
+              'max_ms': ms.max()}
+    print(f"{result['requests']:,} requests ({result['errors']} errors) in {seconds:.1f}s, "
+          f"{result['requests_per_sec']:,.0f} req/s: p50 {result['p50_ms']:.2f} ms, "
+          f"p90 {result['p90_ms']:.2f} ms, p99 {result['p99_ms']:.2f} ms, max {result['max_ms']:.2f} ms")
+    return result
+
+
+if __name__ == '__main__':
+    """ Run from the src folder:
+        python service_functions.py serve --port 8000
+        python service_functions.py loadtest --port 8000 --requests 5000
+    """
+    parser = argparse.ArgumentParser(description='Local query service over the Denver crime data')
+    parser.add_argument('command', choices=['serve', 'loadtest'])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--filename', default='../data/denver_crime.csv')
+    parser.add_argument('--requests', type=int, default=5000)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--distinct', type=int, default=500)
+    args = parser.parse_args()
+    if args.command == 'serve':
+        load_service(args.filename).serve(args.host, args.port)
+    else:
+        load_test(args.host, args.port, args.requests, args.concurrency, args.distinct)
@@ -1,3 +1,5 @@
+from normalize_functions import NEIGHBORHOOD_RENAMES
+
 
 def change_neighborhood(hood):
 
@@ -9,8 +11,10 @@ def change_neighborhood(hood):
     Returns:
         [string]: [name of neighborhood corrected for stapleton change]
     """
-    if hood == 'stapleton':
-        return 'central-park'
+    for old, new, _ in NEIGHBORHOOD_RENAMES:
+        if hood == old:
+            return new
     return hood
 
-# crime['NEIGHBORHOOD_ID'] = crime['NEIGHBORHOOD_ID'].map(change_neighborhood)
+# Mapping every row is slow on the full dataset; rename once per distinct neighborhood instead:
+# crime['NEIGHBORHOOD_ID'] = normalize_functions.rename_neighborhoods(crime['NEIGHBORHOOD_ID'])
@@ -0,0 +1,49 @@
+import numpy as np
+import pandas as pd
+import aggregate_functions
+
+
+def _crimes(n, seed):
+    rng = np.random.default_rng(seed)
+    dates = pd.Timestamp('2019-01-01') + pd.to_timedelta(rng.integers(0, 3 * 365, n), unit='D')
+    return pd.DataFrame({'OFFENSE_CATEGORY_ID': pd.Categorical(rng.choice(['larceny', 'arson', None], n)),
+                         'NEIGHBORHOOD_ID': pd.Categorical(rng.choice(['five-points', 'baker', 'hale'], n)),
+                         'year': dates.year, 'month': dates.month,
+                         'week': dates.isocalendar().week.to_numpy()})
+
+
+def _recount(df):
+    counts = df.groupby(['OFFENSE_CATEGORY_ID', 'NEIGHBORHOOD_ID', 'year'], observed=True).size()
+    return counts[counts > 0].rename('count').reset_index().astype({'OFFENSE_CATEGORY_ID': object,
+                                                                   'NEIGHBORHOOD_ID': object})
+
+
+def test_count_cube_matches_groupby():
+    df = _crimes(500, 0)
+    cube = aggregate_functions.CountCube(df, 'OFFENSE_CATEGORY_ID', 'NEIGHBORHOOD_ID')
+    counts = cube.counts(['category', 'neighborhood', 'year'])
+    counts.columns = ['OFFENSE_CATEGORY_ID', 'NEIGHBORHOOD_ID', 'year', 'count']
+    pd.testing.assert_frame_equal(counts, _recount(df), check_dtype=False)
+
+
+def test_apply_delta_matches_recount():
+    df = _crimes(500, 1)
+    cube = aggregate_functions.CountCube(df, 'OFFENSE_CATEGORY_ID', 'NEIGHBORHOOD_ID')
+    removed = df.iloc[::7]
+    added = _crimes(60, 2)
+    assert cube.apply_delta(removed, added)
+    updated = pd.concat([df.drop(removed.index), added], ignore_index=True)
+    counts = cube.counts(['category', 'neighborhood', 'year'])
+    counts.columns = ['OFFENSE_CATEGORY_ID', 'NEIGHBORHOOD_ID', 'year', 'count']
+    pd.testing.assert_frame_equal(counts, _recount(updated), check_dtype=False)
+    assert cube.counts(['year'])['count'].sum() == len(updated)
+
+
+def test_apply_delta_refuses_unknown_labels():
+    df = _crimes(100, 3)
+    cube = aggregate_functions.CountCube(df, 'OFFENSE_CATEGORY_ID', 'NEIGHBORHOOD_ID')
+    before = cube.cube.copy()
+    added = _crimes(5, 4)
+    added['NEIGHBORHOOD_ID'] = 'nowhere'
+    assert not cube.apply_delta(df.iloc[:0], added)
+    np.testing.assert_array_equal(cube.cube, before)
@@ -0,0 +1,55 @@
+import numpy as np
+import pandas as pd
+import pytest
+import backend_functions
+
+
+@pytest.fixture(scope='module')
+def crimes():
+    rng = np.random.default_rng(0)
+    n = 400
+    return pd.DataFrame({'city': rng.choice(['Denver', 'Seattle'], n),
+                         'year': rng.choice([2019, 2020, 2021], n),
+                         'OFFENSE_CATEGORY_ID': pd.Categorical(rng.choice(['larceny', 'arson', 'burglary'], n)),
+                         'NEIGHBORHOOD_ID': rng.choice(['five-points', 'baker', 'hale', None], n)})
+
+
+@pytest.fixture(scope='module')
+def root(crimes, tmp_path_factory):
+    root = str(tmp_path_factory.mktemp('partitions'))
+    backend_functions.write_partitions(crimes, root)
+    return root
+
+
+QUERIES = [(['year'], None),
+           (['city', 'year'], {'year': [2020, 2021]}),
+           (['OFFENSE_CATEGORY_ID', 'year'], {'city': ['Denver']}),
+           (['NEIGHBORHOOD_ID'], {'city': ['Seattle'], 'OFFENSE_CATEGORY_ID': ['arson', 'larceny']}),
+           (['year'], {'OFFENSE_CATEGORY_ID': []})]
+
+
+def _normalized(counts):
+    counts = counts.astype({col: str for col in counts.columns if col not in ('year', 'count')})
+    return counts.astype({'count': 'int64', **({'year': 'int64'} if 'year' in counts else {})})
+
+
+def _check_agrees(backend, crimes):
+    expected = backend_functions.PandasBackend(crimes)
+    for by, filters in QUERIES:
+        pd.testing.assert_frame_equal(_normalized(backend.count(by, filters)),
+                                      _normalized(expected.count(by, filters)))
+
+
+def test_pool_backend_agrees_with_pandas(crimes, root):
+    _check_agrees(backend_functions.get_backend('pool', root=root, processes=1), crimes)
+
+
+def test_duckdb_backend_agrees_with_pandas(crimes, root):
+    pytest.importorskip('duckdb')
+    _check_agrees(backend_functions.get_backend('duckdb', root=root), crimes)
+
+
+def test_rewriting_partitions_does_not_duplicate_rows(crimes, root):
+    backend_functions.write_partitions(crimes[crimes['year'] == 2020], root)
+    backend = backend_functions.get_backend('pool', root=root, processes=1)
+    assert backend.count(['year'])['count'].sum() == len(crimes)
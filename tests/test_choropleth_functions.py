@@ -0,0 +1,13 @@
+import pandas as pd
+import choropleth_functions
+
+
+def test_quantile_scale_drops_repeated_quantiles():
+    counts = pd.Series([0, 0, 0, 0, 5, 10, 20, 40, 80, 160])
+    assert choropleth_functions.quantile_scale(counts) == sorted(set(counts.quantile((0, 0.3, 0.8, 0.965, 1))))
+
+
+def test_quantile_scale_pads_to_three_bins():
+    assert choropleth_functions.quantile_scale(pd.Series([2, 2, 2])) == [2, 3, 4, 5]
+    assert choropleth_functions.quantile_scale(pd.Series([0] * 99 + [7])) == [0.0, 7.0, 8.0, 9.0]
+    assert choropleth_functions.quantile_scale(pd.Series([], dtype=float)) == [0, 1, 2, 3]
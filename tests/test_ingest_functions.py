@@ -0,0 +1,56 @@
+import numpy as np
+import pandas as pd
+import ingest_functions
+
+
+def _stored():
+    return pd.DataFrame({'INCIDENT_ID': [1, 2, 3],
+                         'OFFENSE_CATEGORY_ID': pd.Categorical(['larceny', 'auto-theft', 'arson']),
+                         'GEO_X': [3146937.0, 3146938.0, np.nan],
+                         'DISTRICT_ID': [3.0, 6.0, np.nan],
+                         'year': np.array([2020, 2020, 2021], dtype='int16')})
+
+
+def test_parse_datetimes_matches_to_datetime():
+    dates = pd.Series(['01/02/2020 12:00:00 AM', '12/31/2019 12:30:15 PM', None,
+                       '07/04/2021 11:59:59 PM', '01/02/2020 12:00:00 AM', '02/29/2020 01:05:09 AM'])
+    expected = pd.to_datetime(dates, format=ingest_functions.FAST_DATE_FORMAT)
+    pd.testing.assert_series_equal(ingest_functions.parse_datetimes(dates, ingest_functions.FAST_DATE_FORMAT),
+                                   expected, check_dtype=False)
+
+
+def test_parse_datetimes_falls_back_for_other_formats():
+    dates = pd.Series(['2020-01-02 00:00:00', None, '2019-12-31 12:30:15'], name='date')
+    expected = pd.to_datetime(dates, format='%Y-%m-%d %H:%M:%S')
+    pd.testing.assert_series_equal(ingest_functions.parse_datetimes(dates, '%Y-%m-%d %H:%M:%S'),
+                                   expected, check_dtype=False)
+
+
+def test_diff_export_ignores_int_float_dtype_differences():
+    stored = _stored()
+    export = pd.DataFrame({'INCIDENT_ID': [1, 2],
+                           'OFFENSE_CATEGORY_ID': ['larceny', 'auto-theft'],
+                           'GEO_X': [3146937, 3146938],
+                           'DISTRICT_ID': pd.Categorical([3, 6])})
+    removed, added = ingest_functions.diff_export(stored, export)
+    assert removed.empty
+    assert added.empty
+
+
+def test_diff_export_finds_new_and_revised_incidents():
+    stored = _stored()
+    export = pd.DataFrame({'INCIDENT_ID': [1, 2, 4],
+                           'OFFENSE_CATEGORY_ID': ['larceny', 'burglary', 'arson'],
+                           'GEO_X': [3146937, 3146938, 3146939],
+                           'DISTRICT_ID': [3, 6, 1]})
+    removed, added = ingest_functions.diff_export(stored, export)
+    assert removed['INCIDENT_ID'].tolist() == [2]
+    assert added['INCIDENT_ID'].tolist() == [2, 4]
+
+
+def test_diff_export_compares_every_row_of_an_incident():
+    stored = pd.DataFrame({'INCIDENT_ID': [1, 1], 'GEO_X': [1.0, 2.0]})
+    assert ingest_functions.diff_export(stored, pd.DataFrame({'INCIDENT_ID': [1, 1], 'GEO_X': [2, 1]}))[1].empty
+    removed, added = ingest_functions.diff_export(stored, pd.DataFrame({'INCIDENT_ID': [1], 'GEO_X': [1]}))
+    assert len(removed) == 2
+    assert len(added) == 1
@@ -0,0 +1,19 @@
+import pandas as pd
+import normalize_functions
+
+
+def test_rename_neighborhoods_applies_renames_from_their_effective_date():
+    series = pd.Series(['stapleton', 'stapleton', 'stapleton', 'five-points', None])
+    dates = pd.Series(pd.to_datetime(['2020-07-31 23:59', '2020-08-01 00:00', None, '2019-01-01 00:00', '2021-01-01 00:00']))
+    renamed = normalize_functions.rename_neighborhoods(series, dates=dates)
+    assert isinstance(renamed.dtype, pd.CategoricalDtype)
+    assert renamed.tolist()[:4] == ['stapleton', 'central-park', 'central-park', 'five-points']
+    assert pd.isna(renamed.iloc[4])
+
+
+def test_rename_neighborhoods_as_of_before_the_rename_keeps_the_old_name():
+    series = pd.Series(['stapleton', 'stapleton'])
+    dates = pd.Series(pd.to_datetime(['2019-01-01 00:00', '2021-01-01 00:00']))
+    assert normalize_functions.rename_neighborhoods(series, as_of='2020-01-01', dates=dates).tolist() == \
+        ['stapleton', 'stapleton']
+    assert normalize_functions.rename_neighborhoods(series).tolist() == ['central-park', 'central-park']